@@ -4,6 +4,66 @@ from __future__ import division
 import numpy as np
 import pandas as pd
 import hashlib
+from scipy import stats
+from collections import OrderedDict
+
+import parallel
+
+def _hash_key(key, salt):
+    """
+    md5("key-salt") -> get the first six digits -> convert into hex number
+    """
+    full_id = "{}-{}".format(key, salt)
+    hashed_id = hashlib.md5(full_id.encode("ascii")).hexdigest()
+    return int(hashed_id[:6], 16)
+
+def _hash_keys(keys, salt):
+    """
+    internal function, hash a list of keys in one pass, the per key work is one md5 call,
+    the first six hex digits are decoded from the raw digests at once
+    """
+    md5 = hashlib.md5
+    suffix = "-{}".format(salt)
+    full_ids = [str(key) + suffix for key in keys]
+    # ascii only as _hash_key, checked once instead of key by key
+    "".join(full_ids).decode("ascii")
+
+    digests = b"".join([md5(full_id).digest()[:3] for full_id in full_ids])
+    digits = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 3).astype(np.int64)
+    return (digits[:, 0] << 16) | (digits[:, 1] << 8) | digits[:, 2]
+
+def _hash_keys_helper(args):
+    """
+    internal function, unpack arguments for the process pool
+    """
+    return _hash_keys(*args)
+
+def hash_keys(keys, salt, n_jobs=1, chunk_size=1000000):
+    """
+    Hash keys in bulk, the same hash as ab_split. Each key still needs one md5 call in python,
+    so a single process is only moderately faster than hashing key by key, n_jobs > 1 scales
+    the hashing with the number of processes
+    Parameters:
+        keys: numpy array, pandas series or list of keys
+        salt: different values in different tests
+        n_jobs: number of processes, -1 means all cores
+        chunk_size: number of keys sent to one process each time
+    Returns:
+        numpy int64 array, hashed ids in [0, 0xFFFFFF]
+    """
+    if isinstance(keys, (np.ndarray, pd.Series, pd.Index)):
+        # the objects that Series.apply passes to ab_split: python scalars for numbers,
+        # Timestamp for datetime64 (not integer nanoseconds) and the values of categoricals
+        keys = pd.Series(keys).astype(object).tolist()
+    else:
+        # mixed types are kept as they are, np.asarray would turn [1, 2.5] into floats
+        keys = list(keys)
+
+    if parallel.num_jobs(n_jobs) <= 1 or len(keys) <= chunk_size:
+        return _hash_keys(keys, salt)
+
+    chunks = [(keys[start: start + chunk_size], salt) for start in range(0, len(keys), chunk_size)]
+    return np.concatenate(parallel.pool_map(_hash_keys_helper, chunks, n_jobs))
 
 def ab_split(key, salt, control_group_ratio):
     """
@@ -18,12 +78,7 @@ def ab_split(key, salt, control_group_ratio):
         t: treatment group
     """
 
-    full_id = "{}-{}".format(key, salt)
-
-    # md5(id) -> get the first six digits -> convert into hex number
-    hashed_id = hashlib.md5(full_id.encode("ascii")).hexdigest()
-    hashed_id = hashed_id[:6]
-    hashed_id = int(hashed_id, 16)
+    hashed_id = _hash_key(key, salt)
 
     result_ratio = hashed_id / 0xFFFFFF
 
@@ -32,9 +87,338 @@ def ab_split(key, salt, control_group_ratio):
     else:
         return 'c'
 
+def ab_split_batch(keys, salt, control_group_ratio, output="label", n_jobs=1):
+    """
+    The vectorized version of ab_split, the results are the same as ab_split key by key
+    Parameters:
+        keys: numpy array, pandas series or list of keys
+        salt: different values in different tests
+        control_group_ratio: the ratio bewteen treatment and control group
+        output: "label" for 'c'/'t' labels, "mask" for boolean treatment mask,
+            "int8" for 1 (treatment) / 0 (control)
+        n_jobs: number of processes to hash keys, -1 means all cores
+    Returns:
+        numpy array of labels or mask, a pandas series with the same index if keys is a series
+    Raises:
+        ValueError if output is unknown
+    """
+    if output not in ("label", "mask", "int8"):
+        raise ValueError("output must be one of label, mask and int8!")
+
+    result_ratio = hash_keys(keys, salt, n_jobs=n_jobs) / 0xFFFFFF
+    is_treatment = result_ratio > control_group_ratio
+
+    if output == "label":
+        result = np.where(is_treatment, 't', 'c').astype(object)
+    elif output == "mask":
+        result = is_treatment
+    else:
+        result = is_treatment.astype(np.int8)
+
+    if isinstance(keys, pd.Series):
+        return pd.Series(result, index=keys.index)
+    return result
+
+class BucketEngine(object):
+    """
+    Hash each key only once into a fixed bucket space, then assign it to all live experiments
+    by array lookups.
+
+    Experiments live in layers. Each layer shuffles the bucket space with its own salt, so the
+    experiments in different layers are orthogonal, while the experiments in the same layer
+    occupy disjoint buckets and are mutually exclusive.
+    """
+    def __init__(self, salt, num_buckets=10000):
+        """
+        Parameters:
+            salt: salt of the key hash, shared by all layers
+            num_buckets: size of the bucket space
+        """
+        self.salt = salt
+        self.num_buckets = num_buckets
+        # layer name -> permutation of bucket space
+        self.layers = OrderedDict()
+        # layer name -> number of layer buckets already occupied
+        self.layer_offsets = {}
+        # experiment name -> (layer name, arm names, bucket to arm index table)
+        self.experiments = OrderedDict()
+
+    def add_layer(self, name, salt=None):
+        """
+        Parameters:
+            name: layer name
+            salt: layer salt, the layer name by default
+        Raises:
+            ValueError if the layer already exists
+        """
+        if name in self.layers:
+            raise ValueError("Layer {} already exists!".format(name))
+        if salt is None:
+            salt = name
+
+        seed = _hash_key(self.salt, salt)
+        self.layers[name] = np.random.RandomState(seed).permutation(self.num_buckets)
+        self.layer_offsets[name] = 0
+
+    def add_experiment(self, name, layer, arms, traffic=1.0):
+        """
+        Parameters:
+            name: experiment name
+            layer: the layer name of the experiment, created if not exists
+            arms: {arm: weight} dict or [(arm, weight), ...] list, weights are normalized
+            traffic: the ratio of layer buckets that the experiment occupies
+        Raises:
+            ValueError if the experiment already exists or the layer is out of buckets
+        """
+        if name in self.experiments:
+            raise ValueError("Experiment {} already exists!".format(name))
+        if layer not in self.layers:
+            self.add_layer(layer)
+
+        if isinstance(arms, dict):
+            arms = list(arms.items())
+        arm_names = [arm for arm, _ in arms]
+        weights = np.asarray([weight for _, weight in arms], dtype=float)
+
+        start = self.layer_offsets[layer]
+        end = start + int(round(traffic * self.num_buckets))
+        if end > self.num_buckets:
+            raise ValueError("Layer {} has only {} free buckets!".format(layer,
+                             self.num_buckets - start))
+
+        # arm boundaries inside [start, end) of the layer bucket space
+        bounds = start + np.round(np.cumsum(weights) / weights.sum() * (end - start)).astype(int)
+        table = -1 * np.ones(self.num_buckets, dtype=np.int16)
+        table[start: end] = np.searchsorted(bounds, np.arange(start, end), side="right")
+
+        self.layer_offsets[layer] = end
+        self.experiments[name] = (layer, arm_names, table)
+
+    def buckets(self, keys, n_jobs=1):
+        """
+        Parameters:
+            keys: numpy array, pandas series or list of keys
+            n_jobs: number of processes to hash keys, -1 means all cores
+        Returns:
+            numpy int64 array, the bucket of each key in [0, num_buckets)
+        """
+        return hash_keys(keys, self.salt, n_jobs=n_jobs) * self.num_buckets // 0x1000000
+
+    def assign(self, keys, n_jobs=1, buckets=None):
+        """
+        Parameters:
+            keys: numpy array, pandas series or list of keys
+            n_jobs: number of processes to hash keys, -1 means all cores
+            buckets: precomputed buckets of keys, skip hashing if given
+        Returns:
+            a dataframe, one categorical column per experiment, NaN if the key is not in the experiment
+        """
+        if buckets is None:
+            buckets = self.buckets(keys, n_jobs=n_jobs)
+        index = keys.index if isinstance(keys, pd.Series) else None
+
+        layer_buckets = {}
+        result = pd.DataFrame(index=index if index is not None else np.arange(len(buckets)))
+        for name, (layer, arm_names, table) in self.experiments.items():
+            if layer not in layer_buckets:
+                layer_buckets[layer] = self.layers[layer][buckets]
+            codes = table[layer_buckets[layer]]
+            result[name] = pd.Categorical.from_codes(codes, arm_names)
+        return result
+
+class ABResultAccumulator(object):
+    """
+    Accumulate the sufficient statistics of each group: count, sum, sum of squares and
+    conversions, so that experiment results can be evaluated chunk by chunk in constant memory.
+    Accumulators built in different processes can be merged.
+    """
+    fields = ["count", "sum", "sum_sq", "conversions"]
+
+    def __init__(self):
+        # group -> [count, sum, sum_sq, conversions]
+        self.stats = {}
+
+    def update(self, groups, values, conversions=None):
+        """
+        Parameters:
+            groups: a list of group labels, such as 'c' and 't'
+            values: a list of metric values
+            conversions: a list of 1 or 0, values > 0 are treated as conversions if not given
+        Returns:
+            self
+        Raises:
+            ValueError if lengths of inputs are not equal
+        """
+        if len(groups) != len(values):
+            raise ValueError("Lengths of groups and values must be equal!")
+
+        values = np.asarray(values).astype(float)
+        if conversions is None:
+            conversions = (values > 0).astype(float)
+        else:
+            if len(conversions) != len(values):
+                raise ValueError("Lengths of conversions and values must be equal!")
+            conversions = np.asarray(conversions).astype(float)
+
+        codes, labels = pd.factorize(np.asarray(groups))
+        num_labels = len(labels)
+        counts = np.bincount(codes, minlength=num_labels)
+        sums = np.bincount(codes, weights=values, minlength=num_labels)
+        sums_sq = np.bincount(codes, weights=values * values, minlength=num_labels)
+        convs = np.bincount(codes, weights=conversions, minlength=num_labels)
+
+        for index, label in enumerate(labels):
+            current = np.array([counts[index], sums[index], sums_sq[index], convs[index]])
+            if label in self.stats:
+                self.stats[label] += current
+            else:
+                self.stats[label] = current
+        return self
+
+    def update_chunks(self, chunks, group_col="group", value_col="value", conversion_col=None):
+        """
+        Parameters:
+            chunks: an iterator of dataframes, such as pd.read_csv(..., chunksize=1000000)
+            group_col: column name of group labels
+            value_col: column name of metric values
+            conversion_col: column name of conversions, optional
+        Returns:
+            self
+        """
+        for chunk in chunks:
+            conversions = None if conversion_col is None else chunk[conversion_col].values
+            self.update(chunk[group_col].values, chunk[value_col].values, conversions)
+        return self
+
+    def merge(self, other):
+        """
+        Parameters:
+            other: another ABResultAccumulator, such as the one from another worker process
+        Returns:
+            self
+        """
+        for label, current in other.stats.items():
+            if label in self.stats:
+                self.stats[label] = self.stats[label] + current
+            else:
+                self.stats[label] = current.copy()
+        return self
+
+    def summary(self):
+        """
+        Returns:
+            a dataframe indexed by group, fields: count, sum, sum_sq, conversions, mean, std,
+            conversion_rate
+        """
+        agg = pd.DataFrame.from_dict(self.stats, orient="index")
+        agg.columns = self.fields
+        agg["mean"] = agg["sum"] / agg["count"]
+        agg["std"] = np.sqrt(self._variance(agg["count"], agg["sum"], agg["sum_sq"]))
+        agg["conversion_rate"] = agg["conversions"] / agg["count"]
+        return agg.sort_index()
+
+    @staticmethod
+    def _variance(count, total, total_sq):
+        """
+        internal function, unbiased sample variance from sums
+        """
+        return np.maximum(total_sq - total * total / count, 0) / (count - 1)
+
+    def _pair(self, control, treatment):
+        """
+        internal function
+        """
+        for label in (control, treatment):
+            if label not in self.stats:
+                raise ValueError("Group {} has no data!".format(label))
+        return self.stats[control], self.stats[treatment]
+
+    def ztest(self, control='c', treatment='t', alpha=0.05):
+        """
+        Two proportions z-test on conversion rates
+        Parameters:
+            control: control group label
+            treatment: treatment group label
+            alpha: significance level, the confidence interval is 1 - alpha
+        Returns:
+            a dict: control_rate, treatment_rate, diff, z, p_value, ci_lower, ci_upper
+        Raises:
+            ValueError if any group has no data
+        """
+        (n_c, _, _, conv_c), (n_t, _, _, conv_t) = self._pair(control, treatment)
+        rate_c, rate_t = conv_c / n_c, conv_t / n_t
+        diff = rate_t - rate_c
+
+        # pooled standard error for the test, unpooled one for the confidence interval
+        pooled = (conv_c + conv_t) / (n_c + n_t)
+        se_pooled = np.sqrt(pooled * (1 - pooled) * (1 / n_c + 1 / n_t))
+        se = np.sqrt(rate_c * (1 - rate_c) / n_c + rate_t * (1 - rate_t) / n_t)
+
+        z = diff / se_pooled if se_pooled > 0 else 0.0
+        p_value = 2 * stats.norm.sf(abs(z))
+        margin = stats.norm.ppf(1 - alpha / 2) * se
+
+        return {"control_rate": rate_c, "treatment_rate": rate_t, "diff": diff, "z": z,
+                "p_value": p_value, "ci_lower": diff - margin, "ci_upper": diff + margin}
+
+    def welch_ttest(self, control='c', treatment='t', alpha=0.05):
+        """
+        Welch's t-test on metric means
+        Parameters:
+            control: control group label
+            treatment: treatment group label
+            alpha: significance level, the confidence interval is 1 - alpha
+        Returns:
+            a dict: control_mean, treatment_mean, diff, t, df, p_value, ci_lower, ci_upper
+        Raises:
+            ValueError if any group has no data
+        """
+        (n_c, sum_c, sum_sq_c, _), (n_t, sum_t, sum_sq_t, _) = self._pair(control, treatment)
+        mean_c, mean_t = sum_c / n_c, sum_t / n_t
+        diff = mean_t - mean_c
+
+        se_c = self._variance(n_c, sum_c, sum_sq_c) / n_c
+        se_t = self._variance(n_t, sum_t, sum_sq_t) / n_t
+        se = np.sqrt(se_c + se_t)
+
+        # Welch-Satterthwaite degrees of freedom
+        dof = (se_c + se_t) ** 2 / (se_c ** 2 / (n_c - 1) + se_t ** 2 / (n_t - 1))
+        t = diff / se if se > 0 else 0.0
+        p_value = 2 * stats.t.sf(abs(t), dof)
+        margin = stats.t.ppf(1 - alpha / 2, dof) * se
+
+        return {"control_mean": mean_c, "treatment_mean": mean_t, "diff": diff, "t": t,
+                "df": dof, "p_value": p_value, "ci_lower": diff - margin, "ci_upper": diff + margin}
+
 if __name__ == "__main__":
     users = pd.DataFrame({"id": np.arange(10000)})
     users["group"] = users.id.apply(lambda x: ab_split(x, "test", 0.7))
 
     print sum(users.group == 'c') / users.count()
 
+    users["group_batch"] = ab_split_batch(users.id, "test", 0.7)
+    print (users.group == users.group_batch).all()
+
+    # the same as ab_split for datetime and categorical keys
+    for keys in (pd.Series(pd.date_range("2018-01-01", periods=1000, freq="H")),
+                 pd.Series(np.random.choice(["a", "b", "c"], 1000)).astype("category")):
+        groups = keys.apply(lambda x: ab_split(x, "test", 0.7))
+        print (groups == ab_split_batch(keys, "test", 0.7)).all()
+
+    engine = BucketEngine("demo")
+    engine.add_experiment("ranking", "algo", {"c": 0.5, "t1": 0.25, "t2": 0.25}, traffic=0.6)
+    engine.add_experiment("recall", "algo", [("c", 1), ("t", 1)], traffic=0.4)
+    engine.add_experiment("ui", "frontend", {"c": 0.9, "t": 0.1})
+    assignment = engine.assign(users.id)
+    for name in assignment.columns:
+        print assignment[name].value_counts(dropna=False)
+    print pd.crosstab(assignment["ranking"], assignment["ui"])
+
+    users["value"] = np.random.exponential(1.0, len(users)) * (np.random.random(len(users)) < 0.3)
+    users.loc[users.group == 't', "value"] *= 1.1
+    accumulator = ABResultAccumulator()
+    for chunk in np.array_split(users, 4):
+        accumulator.merge(ABResultAccumulator().update(chunk.group, chunk.value))
+    print accumulator.summary()
+    print accumulator.ztest()
+    print accumulator.welch_ttest()
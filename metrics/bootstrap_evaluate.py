@@ -0,0 +1,115 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Author: Woody
+Description: This module is for bootstrap confidence intervals of binary model evaluation
+metrics, including auc, ks, optimal cut point, accuracy, precision and recall.
+"""
+
+import numpy as np
+import pandas as pd
+
+import model_evaluate
+import parallel
+from model_evaluate import metric_names
+
+def _bootstrap_replicates(truth_sorted, run_ids, thresholds, seeds, method):
+    """
+    internal function, evaluate replicates on the sorted scores by resample weights
+    Parameters:
+        truth_sorted: ground truth sorted by scores in descending order
+        run_ids: index of the distinct score of each sorted sample
+        thresholds: distinct scores in descending order
+        seeds: one seed per replicate
+        method: "poisson" or "multinomial"
+    Returns:
+        numpy array, (len(seeds), 6)
+    """
+    num_samples = len(truth_sorted)
+    num_runs = len(thresholds)
+    results = np.empty((len(seeds), len(metric_names)))
+
+    for index, seed in enumerate(seeds):
+        random_state = np.random.RandomState(seed)
+        if method == "poisson":
+            weights = random_state.poisson(1.0, num_samples)
+        else:
+            weights = random_state.multinomial(num_samples, np.ones(num_samples) / num_samples)
+
+        pos_weights = np.bincount(run_ids, weights=weights * truth_sorted, minlength=num_runs)
+        all_weights = np.bincount(run_ids, weights=weights, minlength=num_runs)
+        tps = np.cumsum(pos_weights)
+        fps = np.cumsum(all_weights - pos_weights)
+
+        # drop the distinct scores without any resampled sample
+        kept = all_weights > 0
+        result, _ = model_evaluate.cumulative_metrics(thresholds[kept], tps[kept], fps[kept])
+        results[index, :] = result
+    return results
+
+def _bootstrap_replicates_helper(args):
+    """
+    internal function, unpack arguments for the process pool
+    """
+    return _bootstrap_replicates(*args)
+
+def bootstrap_evaluate(truth, pred, num_replicates=1000, alpha=0.05, method="poisson",
+        n_jobs=1, seed=None):
+    """
+    Bootstrap confidence intervals of model_evaluate metrics. The scores are sorted only once,
+    every replicate draws resample weights over the sorted scores instead of resampling data,
+    and metrics are computed exactly as model_evaluate_exact.
+    Parameters:
+        truth: a list of ground truth, 1 or 0
+        pred: a list of guess probabilities, range [0, 1]
+        num_replicates: number of bootstrap replicates
+        alpha: the confidence interval is 1 - alpha, by percentiles
+        method: "poisson" for Poisson(1) weights, "multinomial" for the classic bootstrap
+        n_jobs: number of processes, -1 means all cores
+        seed: random seed, results are the same for any n_jobs with the same seed
+    Returns:
+        a dataframe indexed by metric names, fields: estimate, std, lower, upper
+    Raises:
+        ValueError if both lengths of inputs are not equal or method is unknown
+    """
+    if len(truth) != len(pred):
+        raise ValueError("Lengths of truth and guess must be equal!")
+    if method not in ("poisson", "multinomial"):
+        raise ValueError("method must be poisson or multinomial!")
+
+    truth = np.asarray(truth).astype(int)
+    pred = np.asarray(pred).astype(float)
+
+    valid_indexes = np.logical_or(truth == 0, truth == 1)
+    truth = truth[valid_indexes]
+    pred = pred[valid_indexes]
+
+    estimate = model_evaluate.model_evaluate_exact(truth, pred)
+
+    order = np.argsort(pred, kind="mergesort")[::-1]
+    pred_sorted = pred[order]
+    truth_sorted = truth[order]
+    run_ids = np.r_[0, np.cumsum(np.diff(pred_sorted) != 0)]
+    thresholds = pred_sorted[np.r_[np.flatnonzero(np.diff(pred_sorted)), len(pred_sorted) - 1]]
+
+    # one seed per replicate, so that results do not depend on how replicates are split
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=num_replicates)
+
+    tasks = [(truth_sorted, run_ids, thresholds, seeds_part, method)
+             for seeds_part in np.array_split(seeds, max(parallel.num_jobs(n_jobs), 1))
+             if len(seeds_part) > 0]
+    replicates = np.concatenate(parallel.pool_map(_bootstrap_replicates_helper, tasks, n_jobs))
+
+    agg = pd.DataFrame(index=metric_names)
+    agg["estimate"] = estimate
+    agg["std"] = replicates.std(axis=0, ddof=1)
+    agg["lower"] = np.percentile(replicates, 100 * alpha / 2, axis=0)
+    agg["upper"] = np.percentile(replicates, 100 * (1 - alpha / 2), axis=0)
+    return agg
+
+if __name__ == "__main__":
+    preds = np.random.random(10000)
+    truths = (np.random.random(10000) < preds).astype(int)
+
+    print bootstrap_evaluate(truths, preds, num_replicates=200, seed=2018)
+    print bootstrap_evaluate(truths, preds, num_replicates=200, seed=2018, n_jobs=2)
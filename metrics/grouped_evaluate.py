@@ -0,0 +1,162 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Author: Woody
+Description: This module is for binary model evaluation of many segments (channels, cities,
+product lines, ...) in one pass, the metrics of each segment are the same as model_evaluate_exact.
+"""
+
+import numpy as np
+import pandas as pd
+
+import parallel
+from model_evaluate import metric_names
+
+def _grouped_metrics(truth, pred, codes, num_groups):
+    """
+    internal function, sort by (group, score) once and compute metrics of all groups
+    Parameters:
+        truth: numpy array of ground truth, 1 or 0
+        pred: numpy array of guess probabilities
+        codes: numpy array of group codes in [0, num_groups)
+        num_groups: number of groups
+    Returns:
+        a dataframe indexed by group code, fields: samples, pos_samples, neg_samples, auc, ks,
+        opt_cut, accuracy, precision, recall
+    """
+    order = np.lexsort((-pred, codes))
+    codes = codes[order]
+    pred = pred[order]
+    truth = truth[order]
+    num_samples = len(codes)
+
+    samples = np.bincount(codes, minlength=num_groups)
+    pos_num = np.bincount(codes, weights=truth, minlength=num_groups)
+    neg_num = samples - pos_num
+    group_starts = np.r_[0, np.cumsum(samples)[:-1]]
+
+    # the last index of each run of equal scores inside a group
+    is_end = np.ones(num_samples, dtype=bool)
+    is_end[:-1] = np.logical_or(codes[1:] != codes[:-1], pred[1:] != pred[:-1])
+    ends = np.flatnonzero(is_end)
+    run_codes = codes[ends]
+
+    cum_pos = np.cumsum(truth)
+    pos_before = np.where(group_starts > 0, cum_pos[np.maximum(group_starts - 1, 0)], 0)
+    tps = cum_pos[ends] - pos_before[run_codes]
+    fps = ends + 1 - group_starts[run_codes] - tps
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tpr = tps * 1.0 / pos_num[run_codes]
+        fpr = fps * 1.0 / neg_num[run_codes]
+
+        # auc, trapezoids between consecutive runs of the same group
+        is_first = np.ones(len(ends), dtype=bool)
+        is_first[1:] = run_codes[1:] != run_codes[:-1]
+        prev_tpr = np.where(is_first, 0.0, np.r_[0.0, tpr[:-1]])
+        prev_fpr = np.where(is_first, 0.0, np.r_[0.0, fpr[:-1]])
+        areas = (fpr - prev_fpr) * (tpr + prev_tpr) / 2.0
+        auc = np.bincount(run_codes, weights=areas, minlength=num_groups)
+
+        # ks & optimal cut point, the first run reaching the max ks of each group
+        ks_curve = np.abs(tpr - fpr) * 100
+        ks_curve[np.isnan(ks_curve)] = -1
+        ks = np.full(num_groups, np.nan)
+        ks[np.unique(run_codes)] = np.maximum.reduceat(ks_curve, np.flatnonzero(is_first))
+        candidates = np.flatnonzero(ks_curve == ks[run_codes])
+        best_codes, first_index = np.unique(run_codes[candidates], return_index=True)
+        best = candidates[first_index]
+
+        opt_cut = np.full(num_groups, np.nan)
+        tp = np.full(num_groups, np.nan)
+        fp = np.full(num_groups, np.nan)
+        opt_cut[best_codes] = pred[ends[best]]
+        tp[best_codes] = tps[best]
+        fp[best_codes] = fps[best]
+        fn = pos_num - tp
+        tn = neg_num - fp
+
+        agg = pd.DataFrame(index=np.arange(num_groups))
+        agg["samples"] = samples
+        agg["pos_samples"] = pos_num.astype(int)
+        agg["neg_samples"] = neg_num.astype(int)
+        agg["auc"] = auc
+        agg["ks"] = ks
+        agg["opt_cut"] = opt_cut
+        agg["accuracy"] = (tp + tn) * 1.0 / (tp + fp + fn + tn)
+        agg["precision"] = tp * 1.0 / (tp + fp + 0.000001)
+        agg["recall"] = tp * 1.0 / (tp + fn + 0.0000001)
+
+    # groups without positives or negatives are undefined
+    agg.loc[np.logical_or(pos_num == 0, neg_num == 0), metric_names] = np.nan
+    return agg
+
+def _grouped_metrics_shard(args):
+    """
+    internal function, evaluate one shard of groups for the process pool
+    """
+    truth, pred, codes = args
+    shard_codes, local_codes = np.unique(codes, return_inverse=True)
+    agg = _grouped_metrics(truth, pred, local_codes, len(shard_codes))
+    agg.index = shard_codes
+    return agg
+
+def model_evaluate_grouped(truth, pred, group_keys, n_jobs=1):
+    """
+    Evaluate every group in one pass, sort by (group, score) only once
+    Parameters:
+        truth: a list of ground truth, 1 or 0, others are ignored
+        pred: a list of guess probabilities, range [0, 1]
+        group_keys: a list / series of group keys, or a dataframe of several key columns
+        n_jobs: number of processes, groups are sharded across processes, -1 means all cores
+    Returns:
+        a tidy dataframe, one row per group, fields: group key columns, samples, pos_samples,
+        neg_samples, auc, ks, opt_cut, accuracy, precision, recall
+        groups without positives or negatives have NaN metrics
+    Raises:
+        ValueError if lengths of inputs are not equal
+    """
+    if len(truth) != len(pred) or len(truth) != len(group_keys):
+        raise ValueError("Lengths of truth, guess and group keys must be equal!")
+
+    if isinstance(group_keys, pd.DataFrame):
+        key_names = list(group_keys.columns)
+        keys = pd.MultiIndex.from_arrays([group_keys[name].values for name in key_names])
+    else:
+        key_names = [getattr(group_keys, "name", None) or "group"]
+        keys = np.asarray(group_keys)
+
+    truth = np.asarray(truth).astype(int)
+    pred = np.asarray(pred).astype(float)
+
+    valid_indexes = np.logical_or(truth == 0, truth == 1)
+    truth = truth[valid_indexes]
+    pred = pred[valid_indexes]
+    codes, uniques = pd.factorize(keys[valid_indexes])
+    num_groups = len(uniques)
+
+    n_jobs = parallel.num_jobs(n_jobs)
+    if n_jobs <= 1 or num_groups <= 1:
+        agg = _grouped_metrics(truth, pred, codes, num_groups)
+    else:
+        shards = codes % n_jobs
+        tasks = [(truth[shards == shard], pred[shards == shard], codes[shards == shard])
+                 for shard in range(min(n_jobs, num_groups))]
+        agg = pd.concat(parallel.pool_map(_grouped_metrics_shard, tasks, n_jobs)).sort_index()
+
+    if isinstance(uniques, pd.MultiIndex):
+        for level, name in enumerate(key_names):
+            agg.insert(level, name, uniques.get_level_values(level))
+    else:
+        agg.insert(0, key_names[0], uniques)
+    return agg.reset_index(drop=True)
+
+if __name__ == "__main__":
+    preds = np.random.random(100000)
+    truths = (np.random.random(100000) < preds).astype(int)
+    cities = np.random.choice(["beijing", "shanghai", "guangzhou", "shenzhen"], 100000)
+    channels = np.random.randint(0, 3, 100000)
+
+    print model_evaluate_grouped(truths, preds, cities)
+    print model_evaluate_grouped(truths, preds, pd.DataFrame({"city": cities, "channel": channels}),
+                                 n_jobs=2)
@@ -0,0 +1,143 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Author: Woody
+Description: This module is for out-of-core binary model evaluation. Scores are accumulated
+into fixed resolution histograms chunk by chunk, and auc, ks, optimal cut point, accuracy,
+precision and recall are derived from the histograms, the same as model_evaluate.
+"""
+
+import numpy as np
+import pandas as pd
+
+import model_evaluate
+
+class HistogramEvaluator(object):
+    """
+    Accumulate positive and negative score histograms with fixed bins.
+
+    The cut points are restricted to the bin edges, a sample is predicted positive if its score
+    >= cut point. Accuracy, precision and recall are exact at the returned cut point. Auc and ks
+    are approximate, samples in the same bin are treated as ties, the error bounds are:
+        |auc - exact auc| <= sum(pos_b * neg_b) / (2 * pos * neg)
+        0 <= exact ks - ks <= 100 * max(max(pos_b / pos), max(neg_b / neg))
+    where pos_b and neg_b are the number of positives and negatives in bin b, see error_bounds.
+    """
+    def __init__(self, bins=10000, score_range=(0.0, 1.0)):
+        """
+        Parameters:
+            bins: number of equal length bins
+            score_range: (min, max) of scores, scores out of the range go to the edge bins
+        """
+        self.bins = bins
+        self.score_range = tuple(score_range)
+        self.edges = np.linspace(score_range[0], score_range[1], bins + 1)
+        self.pos_hist = np.zeros(bins, dtype=np.int64)
+        self.neg_hist = np.zeros(bins, dtype=np.int64)
+
+    def update(self, truth, pred):
+        """
+        Parameters:
+            truth: a list of ground truth, 1 or 0, others are ignored
+            pred: a list of guess probabilities
+        Returns:
+            self
+        Raises:
+            ValueError if both lengths of inputs are not equal
+        """
+        if len(truth) != len(pred):
+            raise ValueError("Lengths of truth and guess must be equal!")
+
+        truth = np.asarray(truth).astype(int)
+        pred = np.asarray(pred).astype(float)
+
+        valid_indexes = np.logical_or(truth == 0, truth == 1)
+        truth = truth[valid_indexes]
+        pred = pred[valid_indexes]
+
+        bin_ids = np.searchsorted(self.edges, pred, side="right") - 1
+        bin_ids = np.clip(bin_ids, 0, self.bins - 1)
+
+        self.pos_hist += np.bincount(bin_ids, weights=truth, minlength=self.bins).astype(np.int64)
+        self.neg_hist += np.bincount(bin_ids, weights=1 - truth, minlength=self.bins).astype(np.int64)
+        return self
+
+    def update_chunks(self, chunks, truth_col="truth", pred_col="pred"):
+        """
+        Parameters:
+            chunks: an iterator of dataframes (such as pd.read_csv(..., chunksize=1000000) or
+                parquet row groups) or (truth, pred) tuples
+            truth_col: column name of ground truth in dataframes
+            pred_col: column name of guess probabilities in dataframes
+        Returns:
+            self
+        """
+        for chunk in chunks:
+            if isinstance(chunk, pd.DataFrame):
+                self.update(chunk[truth_col].values, chunk[pred_col].values)
+            else:
+                self.update(*chunk)
+        return self
+
+    def merge(self, other):
+        """
+        Parameters:
+            other: another HistogramEvaluator with the same bins, such as the one from another
+                worker process
+        Returns:
+            self
+        Raises:
+            ValueError if the bins are not the same
+        """
+        if self.bins != other.bins or self.score_range != other.score_range:
+            raise ValueError("Only evaluators with the same bins can be merged!")
+        self.pos_hist += other.pos_hist
+        self.neg_hist += other.neg_hist
+        return self
+
+    def _cumulative(self):
+        """
+        internal function, cumulative counts of non-empty bins from the highest score
+        """
+        pos_hist, neg_hist = self.pos_hist[::-1], self.neg_hist[::-1]
+        non_empty = (pos_hist + neg_hist) > 0
+        thresholds = self.edges[:-1][::-1][non_empty]
+        tps = np.cumsum(pos_hist)[non_empty]
+        fps = np.cumsum(neg_hist)[non_empty]
+        return thresholds, tps, fps
+
+    def evaluate(self, return_curves=False):
+        """
+        Parameters:
+            return_curves: if True, also return the model_evaluate.EvaluationCurves at bin edges
+        Returns:
+            auc, ks, optimal cut point, accuracy, precision and recall
+            (auc, ks, optimal cut point, accuracy, precision and recall), curves if return_curves
+        """
+        curves = model_evaluate.EvaluationCurves(*self._cumulative())
+        if return_curves:
+            return curves.metrics, curves
+        return curves.metrics
+
+    def error_bounds(self):
+        """
+        Returns:
+            a dict, the max absolute error of auc and ks caused by bucketing
+        """
+        pos_num, neg_num = self.pos_hist.sum(), self.neg_hist.sum()
+        auc_bound = np.sum(self.pos_hist * 1.0 * self.neg_hist) / (2.0 * pos_num * neg_num)
+        ks_bound = 100 * max(np.max(self.pos_hist * 1.0 / pos_num),
+                             np.max(self.neg_hist * 1.0 / neg_num))
+        return {"auc": auc_bound, "ks": ks_bound}
+
+if __name__ == "__main__":
+    preds = np.random.random(100000)
+    truths = (np.random.random(100000) < preds).astype(int)
+
+    evaluator = HistogramEvaluator()
+    for index in range(0, 100000, 10000):
+        evaluator.update(truths[index: index + 10000], preds[index: index + 10000])
+
+    print evaluator.evaluate()
+    print evaluator.error_bounds()
+    print model_evaluate.model_evaluate_exact(truths, preds)
@@ -5,25 +5,218 @@ Author: Woody
 Description: This is the keras callback for binary classification evaluation
 """
 
-from sklearn import metrics
+import os
+import sys
+import threading
+import time
+import Queue
+
+import numpy as np
+import pandas as pd
 import keras
 
 import model_evaluate
 
 class Metrics_Callback(keras.callbacks.Callback):
     """Print auc at the end of each epoch, only supporting binary classification.
+
+    The metrics of the latest finished evaluation are also written into logs as val_auc, val_ks
+    and val_opt_cut, so that EarlyStopping and ModelCheckpoint can monitor them. In asynchronous
+    mode the metrics are computed by a background thread while training continues, and logs
+    carry the latest evaluation finished so far, which may be from an earlier epoch.
+
+    Each epoch records the wall time of training, of predicting the validation data and of
+    computing metrics, together with the metrics, in a compact numpy array, see history_frame
+    and save_history.
     """
+    history_fields = ["epoch", "val_loss", "train_time", "predict_time",
+                      "metric_time"] + model_evaluate.metric_names
+    def __init__(self, validation_data=None, eval_every=1, sample_size=None, asynchronous=False,
+                 seed=None):
+        """
+        Parameters:
+            validation_data: (x, y), self.validation_data set by keras is used by default
+            eval_every: evaluate every N epochs
+            sample_size: if given, evaluate on a stratified subsample of this size, drawn once
+            asynchronous: if True, compute metrics on a background thread
+            seed: random seed of the subsample
+        """
+        super(Metrics_Callback, self).__init__()
+        self.eval_data = validation_data
+        self.eval_every = eval_every
+        self.sample_size = sample_size
+        self.asynchronous = asynchronous
+        self.seed = seed
+
     def on_train_begin(self, logs={}):
         self.losses = []
+        # one row per epoch, NaN for the fields not recorded
+        self.history = np.full((16, len(self.history_fields)), np.nan)
+        self.num_epochs = 0
+        self.epoch_start = None
+        self.sample_indexes = None
+        self.lock = threading.Lock()
+        # exc_info of the first failed evaluation in the background thread
+        self.worker_error = None
 
-    def on_epoch_end(self, epoch, logs={}):
-        self.losses.append(logs.get("val_loss", -1))
-        y_pred = self.model.predict(self.validation_data[0])
-        fpr, tpr, thresholds = metrics.roc_curve(self.validation_data[1], y_pred,
-                                                 pos_label=1)
+        if self.asynchronous:
+            self.tasks = Queue.Queue()
+            self.worker = threading.Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _validation(self):
+        """
+        internal function, the validation inputs and labels, subsampled if required
+        """
+        if self.eval_data is not None:
+            x, y = self.eval_data[0], self.eval_data[1]
+        else:
+            x, y = self.validation_data[0], self.validation_data[1]
+        y = np.asarray(y).ravel()
 
-        auc, ks, opt_cut, accuracy, precision, recall = \
-        model_evaluate.model_evaluate(self.validation_data[1], y_pred)
+        if self.sample_size is None or self.sample_size >= len(y):
+            return x, y
+
+        if self.sample_indexes is None:
+            # stratified by labels, each label keeps its ratio
+            random_state = np.random.RandomState(self.seed)
+            indexes = []
+            for label in np.unique(y):
+                label_indexes = np.flatnonzero(y == label)
+                size = int(round(len(label_indexes) * 1.0 * self.sample_size / len(y)))
+                indexes.append(random_state.choice(label_indexes, size, replace=False))
+            self.sample_indexes = np.sort(np.concatenate(indexes))
+
+        if isinstance(x, list):
+            x = [item[self.sample_indexes] for item in x]
+        else:
+            x = x[self.sample_indexes]
+        return x, y[self.sample_indexes]
+
+    def _record(self, epoch, **values):
+        """
+        internal function, write fields of one epoch into the history, grow it if needed
+        """
+        with self.lock:
+            if epoch >= len(self.history):
+                capacity = max(2 * len(self.history), epoch + 1)
+                history = np.full((capacity, len(self.history_fields)), np.nan)
+                history[: len(self.history)] = self.history
+                self.history = history
+            self.num_epochs = max(self.num_epochs, epoch + 1)
+
+            self.history[epoch, 0] = epoch
+            for name, value in values.items():
+                self.history[epoch, self.history_fields.index(name)] = value
+
+    def _evaluate(self, epoch, y_true, y_pred):
+        """
+        internal function, compute and print the metrics of one epoch
+        """
+        start = time.time()
+        result = model_evaluate.model_evaluate_exact(y_true, np.asarray(y_pred).ravel())
+        self._record(epoch, metric_time=time.time() - start,
+                     **dict(zip(model_evaluate.metric_names, result)))
+
+        auc, ks, opt_cut, accuracy, precision, recall = result
         print "\nAt Epoch %d, the current metrics information as follows:\nauc is: %.5f\nks is: %.5f\nopt cut \
         is: %.5f\naccuracy is: %.5f\nprecision is: %.5f\nrecall is: %.5f\n" % (epoch + 1, auc, ks,
                 opt_cut, accuracy, precision, recall)
+
+    def _work(self):
+        """
+        internal function, the background thread evaluating queued predictions, an exception is
+        kept and re-raised on the training thread, the thread keeps draining the queue
+        """
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                if self.worker_error is None:
+                    self._evaluate(*task)
+            except Exception:
+                self.worker_error = sys.exc_info()
+            finally:
+                self.tasks.task_done()
+
+    def _raise_worker_error(self):
+        """
+        internal function, re-raise the exception of the background thread with its traceback
+        """
+        if self.worker_error is not None:
+            exc_type, exc_value, exc_traceback = self.worker_error
+            self.worker_error = None
+            raise exc_type, exc_value, exc_traceback
+
+    def _update_logs(self, logs):
+        """
+        internal function, write the latest finished metrics into logs
+        """
+        auc_index = self.history_fields.index("auc")
+        with self.lock:
+            evaluated = np.flatnonzero(~np.isnan(self.history[: self.num_epochs, auc_index]))
+            if len(evaluated) == 0:
+                return
+            auc, ks, opt_cut = self.history[evaluated[-1], auc_index: auc_index + 3]
+        logs["val_auc"] = auc
+        logs["val_ks"] = ks
+        logs["val_opt_cut"] = opt_cut
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.epoch_start = time.time()
+
+    def on_epoch_end(self, epoch, logs={}):
+        self._raise_worker_error()
+        self.losses.append(logs.get("val_loss", -1))
+        if self.epoch_start is not None:
+            self._record(epoch, val_loss=logs.get("val_loss", np.nan),
+                         train_time=time.time() - self.epoch_start)
+
+        if (epoch + 1) % self.eval_every == 0:
+            x, y_true = self._validation()
+            start = time.time()
+            y_pred = self.model.predict(x)
+            self._record(epoch, predict_time=time.time() - start)
+
+            if self.asynchronous:
+                self.tasks.put((epoch, y_true, y_pred))
+            else:
+                self._evaluate(epoch, y_true, y_pred)
+
+        self._update_logs(logs)
+
+    def on_train_end(self, logs={}):
+        if self.asynchronous:
+            self.tasks.put(None)
+            self.worker.join()
+            self._raise_worker_error()
+
+    def history_frame(self):
+        """
+        Returns:
+            a dataframe, one row per epoch, fields: epoch, val_loss, train_time, predict_time,
+            metric_time, auc, ks, opt_cut, accuracy, precision, recall, times are in seconds
+        """
+        with self.lock:
+            agg = pd.DataFrame(self.history[: self.num_epochs].copy(), columns=self.history_fields)
+        agg["epoch"] = np.arange(len(agg))
+        return agg
+
+    def save_history(self, path, run_id=None):
+        """
+        Append the history into a parquet file, so that it can be queried across runs
+        Parameters:
+            path: the parquet file, created if not exists
+            run_id: identification of this run, the current timestamp by default
+        Returns:
+            the appended dataframe
+        """
+        agg = self.history_frame()
+        agg.insert(0, "run_id", str(run_id if run_id is not None else int(time.time())))
+
+        if os.path.exists(path):
+            agg = pd.concat([pd.read_parquet(path), agg], ignore_index=True)
+        agg.to_parquet(path, index=False)
+        return agg
@@ -3,82 +3,275 @@ calculate the mAP (mean average precision) for object detection task
 Normally we calculate mAP@iou_threshold
 """
 import numpy as np
-from sklearn.metrics import average_precision_score
+import pandas as pd
+
+import parallel
 
 from ..vision import iou
+from ..vision import spatial_index
+from ..vision import box_array
+
+class MAPEvaluator(object):
+    """
+    Accumulate predictions and ground truth of a whole dataset image by image, and evaluate the
+    average precision of each class at several iou thresholds in one pass.
+
+    In each image, predictions of a class are matched in descending order of prob, each one to
+    the first unmatched ground truth bounding box of the same class whose iou >= threshold, the
+    same as calc_map. Inputs are never modified.
+
+    The average precision of a class is the non-interpolated area under its precision / recall
+    curve, sum((recall_i - recall_{i-1}) * precision_i) over the predictions in descending
+    order of prob, where recall is divided by the number of ground truth bounding boxes of the
+    class. A missed bounding box lowers the reachable recall, so one correct prediction and one
+    missed bounding box give 0.5. Classes without ground truth are not evaluated, their
+    predictions are ignored.
+
+    In crowded images, only the overlapping pairs found by a spatial grid index are compared,
+    the results are the same as comparing all pairs.
+    """
+    def __init__(self, iou_thresholds=np.arange(0.5, 0.96, 0.05), sparse_threshold=100000):
+        """
+        Parameters:
+            iou_thresholds: a list of iou thresholds, 0.5:0.95 by default
+            sparse_threshold: use the spatial index if a class in an image has more than this
+                number of prediction and ground truth pairs
+        """
+        self.iou_thresholds = np.round(np.asarray(iou_thresholds, dtype=float).ravel(), 4)
+        self.sparse_threshold = sparse_threshold
+        # class -> list of probs of each image
+        self.probs = {}
+        # class -> list of (number of thresholds, number of predictions) true positive flags
+        self.true_positives = {}
+        # class -> number of ground truth bounding boxes
+        self.num_truths = {}
+
+    @staticmethod
+    def _columns(items):
+        """
+        internal function, classes, (x1, y1, x2, y2) array and probs of roi / bbox dicts or a
+        BoxArray, probs are NaN for bbox dicts
+        """
+        if isinstance(items, box_array.BoxArray):
+            return (np.asarray(items.labels(), dtype=object), items.coords.astype(float),
+                    items.scores.astype(float))
+
+        classes = np.array([item["class"] for item in items], dtype=object)
+        boxes = np.array([[item["x1"], item["y1"], item["x2"], item["y2"]] for item in items],
+                         dtype=float).reshape(-1, 4)
+        probs = np.array([item.get("prob", np.nan) for item in items], dtype=float)
+        return classes, boxes, probs
+
+    def _match(self, ious):
+        """
+        internal function, match sorted predictions to ground truth at all thresholds
+        Parameters:
+            ious: numpy array (number of predictions, number of ground truth)
+        Returns:
+            numpy bool array (number of thresholds, number of predictions)
+        """
+        num_preds, num_truths = ious.shape
+        thresholds = self.iou_thresholds[:, None]
+        true_positives = np.zeros((len(self.iou_thresholds), num_preds), dtype=bool)
+        if num_truths == 0:
+            return true_positives
+
+        matched = np.zeros((len(self.iou_thresholds), num_truths), dtype=bool)
+        for pred_index in range(num_preds):
+            candidates = np.logical_and(ious[pred_index][None, :] >= thresholds, ~matched)
+            found = candidates.any(axis=1)
+            first = candidates.argmax(axis=1)
+            matched[found, first[found]] = True
+            true_positives[:, pred_index] = found
+        return true_positives
+
+    def _match_sparse(self, rows, cols, ious, num_preds, num_truths):
+        """
+        internal function, the same as _match, but only overlapping pairs are given
+        Parameters:
+            rows, cols, ious: see spatial_index.sparse_iou
+            num_preds, num_truths: number of predictions and ground truth
+        Returns:
+            numpy bool array (number of thresholds, number of predictions)
+        """
+        thresholds = self.iou_thresholds[:, None]
+        true_positives = np.zeros((len(self.iou_thresholds), num_preds), dtype=bool)
+        matched = np.zeros((len(self.iou_thresholds), num_truths), dtype=bool)
+
+        bounds = np.searchsorted(rows, np.arange(num_preds + 1))
+        for pred_index in np.unique(rows):
+            start, end = bounds[pred_index], bounds[pred_index + 1]
+            pred_cols = cols[start: end]
+            candidates = np.logical_and(ious[start: end][None, :] >= thresholds,
+                                        ~matched[:, pred_cols])
+            found = candidates.any(axis=1)
+            first = candidates.argmax(axis=1)
+            matched[found, pred_cols[first[found]]] = True
+            true_positives[:, pred_index] = found
+        return true_positives
+
+    def add(self, pred, truth):
+        """
+        Parameters:
+            pred: prediction for one image
+                [roi1, roi2, roi3, ...]
+                roi: {"x1": 1, "x2": 2, "y1": 1, "y2": 2, "class": "cat", "prob": 0.8}
+                or a BoxArray
+            truth: ground truth for one image
+                [bbox1, bbox2, bbox3, ...]
+                bbox: {"x1": 1, "x2": 2, "y1": 1, "y2": 2, "class": "cat"}
+                or a BoxArray
+        Returns:
+            self
+        """
+        pred_classes, pred_boxes, pred_probs = self._columns(pred)
+        truth_classes, truth_boxes, _ = self._columns(truth)
+
+        for class_item in set(pred_classes) | set(truth_classes):
+            class_preds = np.flatnonzero(pred_classes == class_item)
+            class_preds = class_preds[np.argsort(-pred_probs[class_preds], kind="mergesort")]
+            class_truths = np.flatnonzero(truth_classes == class_item)
+
+            # pairs without overlap never match if all thresholds > 0
+            if len(class_preds) * len(class_truths) > self.sparse_threshold and \
+                    self.iou_thresholds.min() > 0:
+                rows, cols, ious = spatial_index.sparse_iou(pred_boxes[class_preds],
+                                                            truth_boxes[class_truths])
+                true_positives = self._match_sparse(rows, cols, ious, len(class_preds),
+                                                    len(class_truths))
+            else:
+                ious = iou.iou_matrix(pred_boxes[class_preds], truth_boxes[class_truths])
+                true_positives = self._match(ious)
+
+            if class_item not in self.num_truths:
+                self.probs[class_item] = []
+                self.true_positives[class_item] = []
+                self.num_truths[class_item] = 0
+            self.probs[class_item].append(pred_probs[class_preds])
+            self.true_positives[class_item].append(true_positives)
+            self.num_truths[class_item] += len(class_truths)
+        return self
+
+    def merge(self, other):
+        """
+        Merge the accumulated state of another evaluator, such as the one built on another shard
+        of images in another process or machine (evaluators can be pickled). The merged result
+        is exactly the same as adding all images into one evaluator.
+        Parameters:
+            other: another MAPEvaluator with the same iou thresholds
+        Returns:
+            self
+        Raises:
+            ValueError if the iou thresholds are not the same
+        """
+        if not np.array_equal(self.iou_thresholds, other.iou_thresholds):
+            raise ValueError("Only evaluators with the same iou thresholds can be merged!")
+
+        for class_item in other.num_truths:
+            if class_item not in self.num_truths:
+                self.probs[class_item] = []
+                self.true_positives[class_item] = []
+                self.num_truths[class_item] = 0
+            self.probs[class_item].extend(other.probs[class_item])
+            self.true_positives[class_item].extend(other.true_positives[class_item])
+            self.num_truths[class_item] += other.num_truths[class_item]
+        return self
+
+    def _average_precision(self, class_item):
+        """
+        internal function, average precision of one class at all thresholds, predictions with
+        the same prob are counted together, so the result does not depend on their order
+        """
+        num_truths = self.num_truths[class_item]
+        probs = np.concatenate(self.probs[class_item])
+        if len(probs) == 0 or num_truths == 0:
+            return np.zeros(len(self.iou_thresholds))
+
+        true_positives = np.concatenate(self.true_positives[class_item], axis=1)
+        order = np.argsort(-probs, kind="mergesort")
+        probs = probs[order]
+        true_positives = true_positives[:, order]
+
+        # the last index of each run of equal probs
+        ends = np.r_[np.flatnonzero(np.diff(probs)), len(probs) - 1]
+        cum_tps = np.cumsum(true_positives, axis=1)[:, ends]
+        precision = cum_tps * 1.0 / (ends + 1)
+        recall = cum_tps * 1.0 / num_truths
+        delta_recall = np.diff(np.c_[np.zeros(len(recall)), recall], axis=1)
+        return np.sum(delta_recall * precision, axis=1)
+
+    def evaluate(self):
+        """
+        Returns:
+            ap_table, mAP
+            ap_table: a dataframe indexed by class, one field per iou threshold, and the field
+                "ap" averaged over thresholds, only classes with ground truth are included
+            mAP: mean of "ap" over classes, NaN if no class has ground truth
+        """
+        classes = sorted(class_item for class_item in self.num_truths
+                         if self.num_truths[class_item] > 0)
+        ap_table = pd.DataFrame([self._average_precision(class_item) for class_item in classes],
+                                index=classes, columns=list(self.iou_thresholds))
+        ap_table["ap"] = ap_table.mean(axis=1)
+        return ap_table, ap_table["ap"].mean()
+
+def _evaluate_shard(args):
+    """
+    internal function, accumulate one shard of images for the process pool
+    """
+    images, iou_thresholds = args
+    evaluator = MAPEvaluator(iou_thresholds=iou_thresholds)
+    for pred, truth in images:
+        evaluator.add(pred, truth)
+    return evaluator
+
+def evaluate_map(images, iou_thresholds=np.arange(0.5, 0.96, 0.05), n_jobs=1):
+    """
+    Evaluate a dataset, images are sharded across processes and the partial evaluators are merged
+    Parameters:
+        images: a list of (pred, truth) of each image, see MAPEvaluator.add
+        iou_thresholds: a list of iou thresholds, 0.5:0.95 by default
+        n_jobs: number of processes, -1 means all cores
+    Returns:
+        ap_table, mAP, see MAPEvaluator.evaluate
+    """
+    images = list(images)
+    n_jobs = parallel.num_jobs(n_jobs)
+    if n_jobs <= 1:
+        return _evaluate_shard((images, iou_thresholds)).evaluate()
+
+    shard_size = (len(images) + n_jobs - 1) // n_jobs
+    tasks = [(images[start: start + shard_size], iou_thresholds)
+             for start in range(0, len(images), shard_size)]
+    evaluators = parallel.pool_map(_evaluate_shard, tasks, n_jobs)
+
+    evaluator = MAPEvaluator(iou_thresholds=iou_thresholds)
+    for partial in evaluators:
+        evaluator.merge(partial)
+    return evaluator.evaluate()
 
 def calc_map(iou_threshold, pred, truth):
     """
-    Calculate the mAP@iou_threshold, all the coordinates are in the original image space
+    Calculate the mAP@iou_threshold, all the coordinates are in the original image space.
+
+    The average precision is the non-interpolated one of MAPEvaluator, recall is divided by the
+    number of ground truth bounding boxes. It differs from the former definition, which scored
+    missed bounding boxes as predictions of prob 0 with sklearn average_precision_score: one
+    correct prediction and one missed bounding box gave 1.0 and now give 0.5. Classes with
+    predictions but no ground truth are left out of the mean, and the result is NaN if there is
+    no ground truth at all.
     Parameters:
-        iou_threshold: only greater than this value it can count
+        iou_threshold: only greater than or equal to this value it can count
         pred: prediction for one image
             [roi1, roi2, roi3, ...]
             roi: {"x1": 1, "x2": 2, "y1": 1, "y2": 2, "class": "cat", "prob": 0.8}
+            or a BoxArray
         truth: ground truth for one image
             [bbox1, bbox2, bbox3, ...]
             bbox: {"x1": 1, "x2": 2, "y1": 1, "y2": 2, "class": "cat"}
+            or a BoxArray
     Returns:
-        mAP@iou_threshold
+        mAP@iou_threshold, NaN if truth is empty
     """
-    result_trues, result_probs = {}, {}
-
-    # we use this flag to identify whether there is a roi ever matched for each bounding box
-    for bbox in truth:
-        bbox["bbox_matched"] = False
-
-    pred_probs = np.array([item["prob"] for item in pred])
-    preds_sorted_by_prob = np.argsort(pred_probs)[::-1]
-
-    for pred_index in preds_sorted_by_prob:
-        pred_item = pred[pred_index]
-        pred_class = pred_item["class"]
-        pred_prob = pred_item["prob"]
-        pred_x1, pred_x2, pred_y1, pred_y2 = pred_item["x1"], pred_item["x2"], pred_item["y1"], pred_item["y2"]
-
-        if pred_class not in result_probs:
-            result_probs[pred_class] = []
-            result_trues[pred_class] = []
-
-        result_probs[pred_class].append(pred_prob)
-        # identify whether True Positive or False Positive
-        found_match = False
-
-        for bbox in truth:
-            truth_class = bbox["class"]
-            truth_x1, truth_x2, truth_y1, truth_y2 = bbox["x1"], bbox["x2"], bbox["y1"], bbox["y2"]
-
-            # if pred and truth are not the same
-            if truth_class != pred_class:
-                continue
-            # if the current bounding box is occupied by anthoer roi
-            # this makes us not to repeat to count true positives 
-            if bbox["bbox_matched"] is True:
-                continue
-
-            current_iou = iou.iou((pred_x1, pred_y1, pred_x2, pred_y2),
-                                  (truth_x1, truth_y1, truth_x2, truth_y2))
-            if current_ious >= iou_threshold:
-                found_match = True
-                bbox["bbox_matched"] = True
-                break
-            else:
-                continue
-
-        result_truth[pred_class].append(int(found_match))
-
-    # we also can't miss False Negative
-    for bbox in truth:
-        if bbox["bbox_matched"] is False:
-            if bbox["class"] not in result_probs:
-                result_probs[bbox["class"]] = []
-                result_truth[bbox["class"]] = []
-            result_probs[bbox["class"]].append(0)
-            result_truth[bbox["class"]].append(1)
-
-    # ok now we start to calculate the metrics
-    all_aps = []
-    for class_item in result_truth:
-        ap = average_precision_score(result_truth[class_item], result_probs[class_item])
-        all_aps.append(ap)
-    return np.mean(all_aps)
+    evaluator = MAPEvaluator(iou_thresholds=[iou_threshold])
+    return evaluator.add(pred, truth).evaluate()[1]
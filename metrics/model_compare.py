@@ -0,0 +1,123 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Author: Woody
+Description: This module is for comparing several binary models on the same ground truth,
+including the metrics of model_evaluate and pairwise DeLong tests for auc differences.
+"""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import model_evaluate
+
+def _midrank(x):
+    """
+    internal function, ranks starting from 1, ties get the average rank
+    """
+    order = np.argsort(x, kind="mergesort")
+    x_sorted = x[order]
+    _, first_index, inverse, counts = np.unique(x_sorted, return_index=True,
+                                                return_inverse=True, return_counts=True)
+    ranks = np.empty(len(x), dtype=float)
+    ranks[order] = (first_index + (counts + 1) / 2.0)[inverse]
+    return ranks
+
+def delong_covariance(pos_preds, neg_preds):
+    """
+    Fast DeLong algorithm by midranks, O(K * n * log(n))
+    Parameters:
+        pos_preds: numpy array (K, m), scores of K models on m positives
+        neg_preds: numpy array (K, n), scores of K models on n negatives
+    Returns:
+        aucs, covariance
+        aucs: numpy array (K, )
+        covariance: numpy array (K, K), covariance of aucs
+    """
+    num_models, m = pos_preds.shape
+    n = neg_preds.shape[1]
+
+    tx = np.empty((num_models, m))
+    ty = np.empty((num_models, n))
+    tz = np.empty((num_models, m + n))
+    for k in range(num_models):
+        tx[k, :] = _midrank(pos_preds[k, :])
+        ty[k, :] = _midrank(neg_preds[k, :])
+        tz[k, :] = _midrank(np.r_[pos_preds[k, :], neg_preds[k, :]])
+
+    aucs = tz[:, :m].sum(axis=1) / m / n - (m + 1.0) / 2.0 / n
+    v01 = (tz[:, :m] - tx) / n
+    v10 = 1.0 - (tz[:, m:] - ty) / m
+    sx = np.atleast_2d(np.cov(v01))
+    sy = np.atleast_2d(np.cov(v10))
+    return aucs, sx / m + sy / n
+
+def compare_models(truth, preds, alpha=0.05):
+    """
+    Evaluate K models against one ground truth, and test auc differences of each pair of
+    models by DeLong test. The ground truth is filtered and split only once for all models.
+    Parameters:
+        truth: a list of ground truth, 1 or 0, others are ignored
+        preds: a dataframe of K score columns, or a 2-d array (samples, K)
+        alpha: significance level, the confidence interval is 1 - alpha
+    Returns:
+        metrics, pairwise
+        metrics: a dataframe indexed by model, fields: auc, ks, opt_cut, accuracy, precision,
+            recall, auc_std
+        pairwise: a dataframe, fields: model_a, model_b, auc_a, auc_b, diff, z, p_value,
+            ci_lower, ci_upper, diff = auc_a - auc_b
+    Raises:
+        ValueError if lengths of inputs are not equal
+    """
+    if isinstance(preds, pd.DataFrame):
+        names = list(preds.columns)
+        preds = preds.values
+    else:
+        preds = np.asarray(preds)
+        names = list(range(preds.shape[1]))
+
+    if len(truth) != preds.shape[0]:
+        raise ValueError("Lengths of truth and guess must be equal!")
+
+    truth = np.asarray(truth).astype(int)
+    preds = preds.astype(float)
+
+    valid_indexes = np.logical_or(truth == 0, truth == 1)
+    truth = truth[valid_indexes]
+    preds = preds[valid_indexes]
+    pos_indexes = truth == 1
+    neg_indexes = truth == 0
+
+    results = [model_evaluate.EvaluationCurves.from_scores(truth, preds[:, k]).metrics
+               for k in range(len(names))]
+    metrics = pd.DataFrame(results, index=names,
+                           columns=model_evaluate.metric_names)
+
+    aucs, covariance = delong_covariance(preds[pos_indexes].T, preds[neg_indexes].T)
+    metrics["auc_std"] = np.sqrt(np.diag(covariance))
+
+    z_alpha = stats.norm.ppf(1 - alpha / 2.0)
+    rows = []
+    for i, j in itertools.combinations(range(len(names)), 2):
+        diff = aucs[i] - aucs[j]
+        std = np.sqrt(max(covariance[i, i] + covariance[j, j] - 2 * covariance[i, j], 0))
+        z = diff / std if std > 0 else 0.0
+        p_value = 2 * stats.norm.sf(abs(z))
+        rows.append([names[i], names[j], aucs[i], aucs[j], diff, z, p_value,
+                     diff - z_alpha * std, diff + z_alpha * std])
+    pairwise = pd.DataFrame(rows, columns=["model_a", "model_b", "auc_a", "auc_b", "diff", "z",
+                                           "p_value", "ci_lower", "ci_upper"])
+    return metrics, pairwise
+
+if __name__ == "__main__":
+    truths = np.random.randint(2, size=10000)
+    preds = pd.DataFrame({"weak": truths * 0.2 + np.random.random(10000),
+                          "medium": truths * 0.4 + np.random.random(10000),
+                          "strong": truths * 0.45 + np.random.random(10000)})
+
+    metrics, pairwise = compare_models(truths, preds)
+    print metrics
+    print pairwise
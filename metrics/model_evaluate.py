@@ -16,16 +16,21 @@ import numpy as np
 import sklearn
 from sklearn import metrics
 
-def model_evaluate(truth, pred):
+def model_evaluate(truth, pred, exact=False):
     """
     Parameters:
         truth: a list of ground truth, 1 or 0
         pred: a list of guess probabilities, range [0, 1]
+        exact: if True, compute exact ks and optimal cut by sorting scores once,
+            see model_evaluate_exact, otherwise use 1000 equal length buckets
     Returns:
         auc, ks, optimal cut point, accuracy, precision and recall
     Raises:
         ValueError if both lengths of inputs are not equal
     """
+    if exact:
+        return model_evaluate_exact(truth, pred)
+
     if len(truth) != len(pred):
         raise ValueError("Lengths of truth and guess must be equal!")
 
@@ -74,19 +79,278 @@ def model_evaluate(truth, pred):
 
     return auc, ks, opt_cut, accuracy, precision, recall
 
-def evaluate_by_segments(truth, pred, buckets=20):
+def sorted_cumulative(truth, pred):
     """
+    Sort the scores once in descending order and count samples at each distinct score
     Parameters:
-        truth: a list of ground truth, 1 or 0, neither 1 nor 0 means non-performance sample
+        truth: numpy array of ground truth, 1 or 0
+        pred: numpy array of guess probabilities
+    Returns:
+        thresholds, tps, fps
+        thresholds: distinct scores in descending order
+        tps: number of positives whose scores >= threshold
+        fps: number of negatives whose scores >= threshold
+    """
+    order = np.argsort(pred, kind="mergesort")[::-1]
+    pred_sorted = pred[order]
+    truth_sorted = truth[order]
+
+    # the last index of each run of equal scores
+    ends = np.r_[np.flatnonzero(np.diff(pred_sorted)), len(pred_sorted) - 1]
+    tps = np.cumsum(truth_sorted)[ends]
+    fps = ends + 1 - tps
+
+    return pred_sorted[ends], tps, fps
+
+# the names of the metrics tuple of model_evaluate and cumulative_metrics
+metric_names = ["auc", "ks", "opt_cut", "accuracy", "precision", "recall"]
+
+def cumulative_metrics(thresholds, tps, fps):
+    """
+    Derive all metrics from the cumulative counts, a sample is predicted positive if its
+    score >= cut point
+    Parameters:
+        thresholds: scores in descending order
+        tps: number (or weights) of positives whose scores >= threshold
+        fps: number (or weights) of negatives whose scores >= threshold
+    Returns:
+        (auc, ks, optimal cut point, accuracy, precision, recall), curves
+        curves: a dict of numpy arrays, thresholds, tps, fps, tpr, fpr, ks
+    """
+    pos_num, neg_num = tps[-1], fps[-1]
+    tpr = tps * 1.0 / pos_num
+    fpr = fps * 1.0 / neg_num
+
+    auc = np.trapz(np.r_[0, tpr], np.r_[0, fpr])
+
+    ks_curve = np.abs(tpr - fpr) * 100
+    opt_index = np.argmax(ks_curve)
+    ks = ks_curve[opt_index]
+    opt_cut = thresholds[opt_index]
+
+    tp = tps[opt_index]
+    fp = fps[opt_index]
+    fn = pos_num - tp
+    tn = neg_num - fp
+
+    accuracy = (tp + tn) * 1.0 / (tp + fp + fn + tn)
+    precision = tp * 1.0 / (tp + fp + 0.000001)
+    recall = tp * 1.0 / (tp + fn + 0.0000001)
+
+    curves = {"thresholds": thresholds, "tps": tps, "fps": fps, "tpr": tpr, "fpr": fpr,
+              "ks": ks_curve}
+    return (auc, ks, opt_cut, accuracy, precision, recall), curves
+
+def downsample_curve(x, y, max_error):
+    """
+    Downsample a curve for plotting, the polyline through the kept points is within max_error
+    (euclidean distance) of every dropped point
+    Parameters:
+        x, y: numpy arrays of the curve points
+        max_error: max distance, in the units of x and y
+    Returns:
+        numpy array of the indexes of the kept points, the first and last points are always kept
+    """
+    num_points = len(x)
+    if num_points <= 2 or not max_error:
+        return np.arange(num_points)
+
+    # grid cells with diagonal max_error, a dropped point shares the cell with both the kept
+    # points around it, so it is within the cell containing the segment between them
+    cell_size = max_error / np.sqrt(2)
+    cell_x = np.floor(np.asarray(x) / cell_size)
+    cell_y = np.floor(np.asarray(y) / cell_size)
+    changed = np.logical_or(cell_x[1:] != cell_x[:-1], cell_y[1:] != cell_y[:-1])
+
+    kept = np.zeros(num_points, dtype=bool)
+    kept[0] = kept[-1] = True
+    kept[1:] |= changed
+    kept[:-1] |= changed
+    return np.flatnonzero(kept)
+
+class EvaluationCurves(object):
+    """
+    ROC curve, PR curve, KS cumulative curves and the metrics of model_evaluate, all derived
+    from the same cumulative arrays, so they are computed once and shared by evaluation and
+    plotting.
+    Attributes:
+        thresholds: scores in descending order
+        tps, fps: number of positives / negatives whose scores >= threshold
+        tpr, fpr: true / false positive ratio at each threshold
+        precision, recall: precision / recall at each threshold
+        ks_curve: ks at each threshold
+        metrics: (auc, ks, optimal cut point, accuracy, precision, recall)
+        auc, ks, opt_cut, opt_index: the optimal point
+    """
+    def __init__(self, thresholds, tps, fps):
+        """
+        Parameters:
+            thresholds, tps, fps: see sorted_cumulative
+        """
+        self.metrics, curves = cumulative_metrics(thresholds, tps, fps)
+        self.thresholds = thresholds
+        self.tps = tps
+        self.fps = fps
+        self.tpr = curves["tpr"]
+        self.fpr = curves["fpr"]
+        self.ks_curve = curves["ks"]
+        self.precision = tps * 1.0 / (tps + fps)
+        self.recall = self.tpr
+
+        self.auc, self.ks, self.opt_cut = self.metrics[:3]
+        self.opt_index = int(np.argmax(self.ks_curve))
+
+    @classmethod
+    def from_scores(cls, truth, pred):
+        """
+        Parameters:
+            truth: numpy array of ground truth, 1 or 0
+            pred: numpy array of guess probabilities
+        Returns:
+            EvaluationCurves
+        """
+        return cls(*sorted_cumulative(truth, pred))
+
+    def roc_curve(self, max_error=None):
+        """
+        Parameters:
+            max_error: if given, downsample the curve within this distance
+        Returns:
+            fpr, tpr, starting from (0, 0)
+        """
+        fpr, tpr = np.r_[0, self.fpr], np.r_[0, self.tpr]
+        kept = downsample_curve(fpr, tpr, max_error)
+        return fpr[kept], tpr[kept]
+
+    def pr_curve(self, max_error=None):
+        """
+        Parameters:
+            max_error: if given, downsample the curve within this distance
+        Returns:
+            recall, precision
+        """
+        kept = downsample_curve(self.recall, self.precision, max_error)
+        return self.recall[kept], self.precision[kept]
+
+    def ks_cumulative(self, max_error=None):
+        """
+        Parameters:
+            max_error: if given, downsample the curves within this distance
+        Returns:
+            thresholds, pos_cum, neg_cum
+            pos_cum / neg_cum: ratio of positives / negatives whose scores < threshold
+        """
+        pos_cum, neg_cum = 1 - self.tpr, 1 - self.fpr
+        kept = np.union1d(downsample_curve(self.thresholds, pos_cum, max_error),
+                          downsample_curve(self.thresholds, neg_cum, max_error))
+        return self.thresholds[kept], pos_cum[kept], neg_cum[kept]
+
+def model_evaluate_exact(truth, pred, return_curves=False):
+    """
+    Sort the scores once, and derive auc, exact ks, optimal cut point and confusion counts
+    from the same cumulative arrays, no bucketing
+    Parameters:
+        truth: a list of ground truth, 1 or 0
         pred: a list of guess probabilities, range [0, 1]
-        buckets: number of equal lengths of buckets cut in [0, 1]
+        return_curves: if True, also return the EvaluationCurves
+    Returns:
+        auc, ks, optimal cut point, accuracy, precision and recall
+        (auc, ks, optimal cut point, accuracy, precision and recall), curves if return_curves
+    Raises:
+        ValueError if both lengths of inputs are not equal
+    """
+    if len(truth) != len(pred):
+        raise ValueError("Lengths of truth and guess must be equal!")
+
+    truth = np.asarray(truth).astype(int)
+    pred = np.asarray(pred).astype(float)
+
+    valid_indexes = np.logical_or(truth == 0, truth == 1)
+    truth = truth[valid_indexes]
+    pred = pred[valid_indexes]
+
+    curves = EvaluationCurves.from_scores(truth, pred)
+    if return_curves:
+        return curves.metrics, curves
+    return curves.metrics
+
+def segment_edges(pred, buckets=20, method="width"):
+    """
+    Parameters:
+        pred: numpy array of guess probabilities
+        buckets: number of buckets
+        method: "width" for equal length buckets in [0, 1] (extended to cover all scores),
+            "quantile" for equal frequency buckets
+    Returns:
+        numpy array of bucket edges, buckets are right closed, the first edge is moved down by
+        0.1% of the range as pd.cut does, so that the minimum score is included
+    Raises:
+        ValueError if method is unknown
+    """
+    if method == "width":
+        low = min(0.0, pred.min()) if len(pred) > 0 else 0.0
+        high = max(1.0, pred.max()) if len(pred) > 0 else 1.0
+        edges = np.linspace(low, high, buckets + 1)
+    elif method == "quantile":
+        edges = np.unique(np.percentile(pred, np.linspace(0, 100, buckets + 1)))
+        if len(edges) == 1:
+            edges = np.r_[edges, edges[0] + 1.0]
+    else:
+        raise ValueError("method must be width or quantile!")
+
+    edges[0] -= (edges[-1] - edges[0]) * 0.001
+    return edges
+
+def segment_table(truth, pred, edges):
+    """
+    Parameters:
+        truth: numpy array of ground truth, 1 or 0, neither 1 nor 0 means non-performance sample
+        pred: numpy array of guess probabilities
+        edges: bucket edges, see segment_edges
+    Returns:
+        buckets segments performance, see evaluate_by_segments
+    """
+    num_buckets = len(edges) - 1
+    bucket_ids = np.searchsorted(edges, pred, side="left") - 1
+    np.clip(bucket_ids, 0, num_buckets - 1, out=bucket_ids)
+
+    total_samples = np.bincount(bucket_ids, minlength=num_buckets)
+    pos_samples = np.bincount(bucket_ids, weights=(truth == 1), minlength=num_buckets).astype(int)
+    neg_samples = np.bincount(bucket_ids, weights=(truth == 0), minlength=num_buckets).astype(int)
+
+    agg = pd.DataFrame()
+    agg["bucket"] = pd.cut(np.array([]), edges).categories.astype(object)
+    agg["total_samples"] = total_samples
+    agg["pos_samples"] = pos_samples
+    agg["neg_samples"] = neg_samples
+    agg["has_perf_samples"] = pos_samples + neg_samples
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        agg["total_samples_ratio"] = agg["total_samples"] * 1.0 / agg["total_samples"].sum()
+        agg["has_perf_samples_ratio"] = agg["has_perf_samples"] * 1.0 / agg["has_perf_samples"].sum()
+        agg["precision"] = agg["pos_samples"] * 1.0 / agg["has_perf_samples"]
+        agg["recall"] = agg["pos_samples"] * 1.0 / agg["pos_samples"].sum()
+
+    return agg.fillna(0)
+
+def evaluate_by_segments(truth, pred, buckets=20, method="width"):
+    """
+    Parameters:
+        truth: a list of ground truth, 1 or 0, neither 1 nor 0 means non-performance sample
+        pred: a list of guess probabilities, range [0, 1], or a dataframe / 2-d array of
+            several score columns
+        buckets: number of buckets
+        method: "width" for equal lengths of buckets cut in [0, 1],
+            "quantile" for equal frequency buckets of each score column
     Returns:
         buckets segments performance, fields as follows:
 
-        score_range \t total_samples \t total samples ratio \t has_perf_samples \t
-        has_perf_samples_ratio \t neg_samples \t pos_samples \t precision \t recall
+        bucket \t total_samples \t pos_samples \t neg_samples \t has_perf_samples \t
+        total_samples_ratio \t has_perf_samples_ratio \t precision \t recall
 
-        which score ranges are [0, 0.05], (0.05, 0.1], (0.1, 0.15], ..., (0.95, 1] if buckets=20 
+        which score ranges are [0, 0.05], (0.05, 0.1], (0.1, 0.15], ..., (0.95, 1] if buckets=20
+        and method="width". For several score columns, the tables are concatenated with an extra
+        leading field "score" of the column name.
     Raises:
         ValueError if both lengths of inputs are not equal
     """
@@ -94,46 +358,96 @@ def evaluate_by_segments(truth, pred, buckets=20):
     if len(truth) != len(pred):
         raise ValueError("Lengths of truth and guesst must be equal!")
 
-    truth = np.asarray(truth).astype(int)
-    pred = np.asarray(pred).astype(float)
-    sentinel = np.asarray(["non"] * len(truth))
+    truth = np.asarray(truth)
 
-    # add sentinels of 0 and 1
-    truth = np.append(truth, -999)
-    pred = np.append(pred, 0)
-    sentinel = np.append(sentinel, "sentinel")
+    if isinstance(pred, pd.DataFrame):
+        columns = [(name, pred[name].values) for name in pred.columns]
+    else:
+        pred = np.asarray(pred)
+        if pred.ndim == 1:
+            columns = None
+        else:
+            columns = [(index, pred[:, index]) for index in range(pred.shape[1])]
 
-    truth = np.append(truth, -999)
-    pred = np.append(pred, 1)
-    sentinel = np.append(sentinel, "sentinel")
+    if columns is None:
+        pred = pred.astype(float)
+        return segment_table(truth, pred, segment_edges(pred, buckets, method))
 
-    data = pd.DataFrame({"pos": truth, "pred": pred}, index=sentinel)
-    data["neg"] = 1 - data["pos"]
-    data.loc[data["pos"] != 1, "pos"] = 0
-    data.loc[data["neg"] != 1, "neg"] = 0
-    data["bucket"] = pd.cut(data["pred"], buckets)
-    data.drop("sentinel", inplace=True)
+    tables = []
+    for name, values in columns:
+        values = values.astype(float)
+        agg = segment_table(truth, values, segment_edges(values, buckets, method))
+        agg.insert(0, "score", name)
+        tables.append(agg)
+    return pd.concat(tables, ignore_index=True)
+
+def evaluate_top_k(truth, pred, top=(0.01, 0.05, 0.1)):
+    """
+    Lift, cumulative gain, precision@k and recall@k of the highest scores. Only the top scores
+    are selected by partial sort (argpartition), there is no full sort.
+    Parameters:
+        truth: a list of ground truth, 1 or 0, neither 1 nor 0 means non-performance sample
+        pred: a list of guess probabilities, range [0, 1]
+        top: a list of k, floats in (0, 1] are ratios of all samples, integers are numbers of
+            samples
+    Returns:
+        cumulative top k performance, one row per k, the same fields as evaluate_by_segments
+        plus the following:
+
+        k \t lift
 
-    grouped = data.groupby("bucket", as_index=False)
+        k is the given k as is (object column), total_samples is the number of samples selected
 
+        bucket is the score range [k-th highest score, highest score], recall is the cumulative
+        gain, lift is precision divided by the precision of all samples
+    Raises:
+        ValueError if both lengths of inputs are not equal
+    """
+    if len(truth) != len(pred):
+        raise ValueError("Lengths of truth and guess must be equal!")
+
+    truth = np.asarray(truth)
+    pred = np.asarray(pred).astype(float)
+    num_samples = len(pred)
+
+    top_k = [int(round(k * num_samples)) if isinstance(k, float) and k <= 1 else int(k)
+             for k in top]
+    top_k = [min(max(k, 1), num_samples) for k in top_k]
+    max_k = max(top_k)
+
+    if max_k < num_samples:
+        top_indexes = np.argpartition(-pred, max_k - 1)[:max_k]
+    else:
+        top_indexes = np.arange(num_samples)
+    top_indexes = top_indexes[np.argsort(-pred[top_indexes], kind="mergesort")]
+
+    top_pred = pred[top_indexes]
+    cum_pos = np.cumsum(truth[top_indexes] == 1)
+    cum_neg = np.cumsum(truth[top_indexes] == 0)
+    total_pos = np.sum(truth == 1)
+    total_perf = total_pos + np.sum(truth == 0)
+
+    positions = np.asarray(top_k) - 1
     agg = pd.DataFrame()
-    agg["bucket"] = grouped.apply(lambda x: x.name)
-    agg["total_samples"] = grouped.count()["pred"]
-    agg["pos_samples"] = grouped.sum()["pos"]
-    agg["neg_samples"] = grouped.sum()["neg"]
+    agg["bucket"] = [pd.Interval(top_pred[position], top_pred[0], closed="both")
+                     for position in positions]
+    agg["total_samples"] = np.asarray(top_k)
+    agg["pos_samples"] = cum_pos[positions]
+    agg["neg_samples"] = cum_neg[positions]
     agg["has_perf_samples"] = agg["pos_samples"] + agg["neg_samples"]
 
-    agg["total_samples_ratio"] = agg["total_samples"] * 1.0 / agg["total_samples"].sum()
-    agg["has_perf_samples_ratio"] = agg["has_perf_samples"] * 1.0 / agg["has_perf_samples"].sum()
-    agg["precision"] = agg["pos_samples"] * 1.0 / agg["has_perf_samples"]
-    agg["recall"] = agg["pos_samples"] * 1.0 / agg["pos_samples"].sum()
-
-    agg = agg.sort_values(by="bucket").reset_index(drop=True)
-    agg = agg.fillna(0)
-    agg["pos_samples"] = agg["pos_samples"].astype(int)
-    agg["neg_samples"] = agg["neg_samples"].astype(int)
-    agg["has_perf_samples"] = agg["has_perf_samples"].astype(int)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        agg["total_samples_ratio"] = agg["total_samples"] * 1.0 / num_samples
+        agg["has_perf_samples_ratio"] = agg["has_perf_samples"] * 1.0 / total_perf
+        agg["precision"] = agg["pos_samples"] * 1.0 / agg["has_perf_samples"]
+        agg["recall"] = agg["pos_samples"] * 1.0 / total_pos
+        # object column, so that ratios (1.0) and numbers of samples (1) stay distinguishable
+        agg["k"] = pd.Series(list(top), dtype=object)
+        agg["lift"] = agg["precision"] / (total_pos * 1.0 / total_perf)
 
+    # fillna would infer a numeric dtype for k
+    filled = agg.columns.drop("k")
+    agg[filled] = agg[filled].fillna(0)
     return agg
 
 if __name__ == "__main__":
@@ -141,7 +455,10 @@ if __name__ == "__main__":
     truths = np.random.randint(2, size=10000)
 
     print model_evaluate(truths, preds)
+    print model_evaluate(truths, preds, exact=True)
 
     preds = np.random.random(10000)
     truths = np.random.randint(2, size=10000)
     print evaluate_by_segments(truths, preds)
+    print evaluate_by_segments(truths, np.c_[preds, preds ** 2], buckets=10, method="quantile")
+    print evaluate_top_k(truths, preds, top=[0.01, 0.05, 0.1, 500])
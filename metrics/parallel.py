@@ -0,0 +1,41 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Author: Woody
+Description: This module is the process pool dispatch shared by the metrics modules.
+"""
+
+import multiprocessing
+
+def num_jobs(n_jobs):
+    """
+    Parameters:
+        n_jobs: number of processes, -1 means all cores
+    Returns:
+        the number of processes
+    """
+    if n_jobs == -1:
+        return multiprocessing.cpu_count()
+    return n_jobs
+
+def pool_map(func, tasks, n_jobs):
+    """
+    Map a function over tasks with a process pool, the pool is always closed and joined
+    Parameters:
+        func: a module level function of one argument, so that it can be pickled
+        tasks: a list of arguments
+        n_jobs: number of processes, -1 means all cores
+    Returns:
+        a list of results in the order of tasks, computed in this process if n_jobs <= 1 or
+        there is only one task
+    """
+    n_jobs = num_jobs(n_jobs)
+    if n_jobs <= 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+
+    pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,193 @@
+from __future__ import division
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import pd_memory
+
+def infer_dtypes(sample, category_ratio=0.5, float_tolerance=None, allow_unsigned=False):
+    """
+    Parameters:
+        sample: a sample dataframe of the file
+        category_ratio: object columns whose ratio of unique values < category_ratio are
+            read as category
+        float_tolerance: if given, float64 columns within this relative error are read as float32
+        allow_unsigned: non-negative integer columns may be read as unsigned dtypes
+    Returns:
+        a dict, column -> compact dtype inferred from the sample
+    """
+    sample = sample.copy()
+    pd_memory.optimize(sample, category_ratio=category_ratio, float_tolerance=float_tolerance,
+                       allow_unsigned=allow_unsigned)
+    return dict((column, sample[column].dtype) for column in sample.columns)
+
+def _compact_chunk(chunk, dtypes, float_tolerance):
+    """
+    internal function, apply compact dtypes to a chunk column by column, integers are widened
+    if the chunk does not fit the dtype from the sample
+    Returns:
+        a dict, column -> series
+    """
+    columns = {}
+    for column in chunk.columns:
+        series = chunk[column]
+        dtype = dtypes.get(column)
+
+        if dtype is None:
+            pass
+        elif pd.api.types.is_categorical_dtype(dtype):
+            series = series.astype("category")
+        elif pd.api.types.is_integer_dtype(dtype) and pd.api.types.is_integer_dtype(series.dtype):
+            if len(series) > 0:
+                # unsigned only if the sample was read as unsigned
+                series = series.astype(pd_memory._smallest_int_dtype(
+                    series.min(), series.max(), allow_unsigned=dtype.kind == "u"))
+        elif dtype == np.float32 and series.dtype == np.float64:
+            series = pd_memory.optimize_series(series, float_tolerance=float_tolerance)
+
+        columns[column] = series
+    return columns
+
+def _concat_column(parts):
+    """
+    internal function, concatenate the parts of one column, integer parts are widened to a
+    common integer dtype, or object if uint64 and negative values can not share one
+    """
+    if all(pd.api.types.is_categorical_dtype(part.dtype) for part in parts):
+        return pd.Series(union_categoricals(parts))
+    if all(pd.api.types.is_integer_dtype(part.dtype) for part in parts):
+        dtype = np.result_type(*[part.dtype for part in parts])
+        if dtype.kind not in "iu":
+            # uint64 and signed parts, int64 if the uint64 values fit
+            fits = all(part.max() <= np.uint64(np.iinfo(np.int64).max) for part in parts
+                       if part.dtype == np.uint64)
+            dtype = np.dtype(np.int64) if fits else np.dtype(np.object_)
+        return pd.Series(np.concatenate([part.values.astype(dtype) for part in parts]))
+    return pd.Series(np.concatenate([part.values for part in parts]))
+
+def _usage_bytes(columns):
+    """
+    internal function, memory of a dict of series, object columns are estimated by sampling
+    """
+    return sum(pd_memory.estimate_usage(series)["bytes"].sum() for series in columns.values())
+
+def read_csv_compact(path, memory_budget=None, chunksize=1000000, sample_rows=100000,
+        category_ratio=0.5, float_tolerance=None, allow_unsigned=False, **kwargs):
+    """
+    Load a csv file into a memory optimized dataframe:
+        infer compact dtypes (downcast numerics, categoricals) from the first sample_rows rows
+        stream the file in chunks with those dtypes applied
+        concatenate the chunks column by column
+    Parameters:
+        path: csv file path
+        memory_budget: max bytes that the loaded data may take, None for no limit
+        chunksize: number of rows of each chunk
+        sample_rows: number of rows to infer dtypes
+        category_ratio: object columns whose ratio of unique values in the sample < category_ratio
+            are read as category
+        float_tolerance: if given, float64 columns within this relative error are read as float32
+        allow_unsigned: non-negative integer columns may be read as unsigned dtypes, whose
+            subtraction wraps around, signed dtypes only by default
+        kwargs: other parameters of pd.read_csv, dtype given here takes priority over the
+            inferred dtypes, index_col is kept as the index, nrows caps both the sample and the
+            stream, iterator is not supported
+    Returns:
+        df, report
+        report: a dict, rows, chunks, peak_memory, final_memory, peak_bytes, final_bytes
+    Raises:
+        MemoryError if the memory budget would be exceeded
+        ValueError if iterator is given in kwargs
+    """
+    if "iterator" in kwargs:
+        raise ValueError("iterator is not supported, the file is always read in chunks!")
+    user_dtypes = kwargs.pop("dtype", None) or {}
+    nrows = kwargs.pop("nrows", None)
+    if nrows is not None:
+        sample_rows = min(sample_rows, nrows)
+    sample = pd.read_csv(path, nrows=sample_rows, dtype=user_dtypes, **kwargs)
+    dtypes = infer_dtypes(sample, category_ratio=category_ratio, float_tolerance=float_tolerance,
+                          allow_unsigned=allow_unsigned)
+    read_dtypes = dict((column, "category") for column, dtype in dtypes.items()
+                       if pd.api.types.is_categorical_dtype(dtype))
+    if isinstance(user_dtypes, dict):
+        read_dtypes.update(user_dtypes)
+        for column in user_dtypes:
+            dtypes.pop(column, None)
+    else:
+        # one dtype for all the columns
+        read_dtypes, dtypes = user_dtypes, {}
+    columns = list(sample.columns)
+    del sample
+
+    def check_budget(usage_bytes, stage):
+        if memory_budget is not None and usage_bytes > memory_budget:
+            raise MemoryError("Loading {} needs {} while {}, exceeding the budget {}!".format(
+                path, pd_memory.format_bytes(usage_bytes), stage,
+                pd_memory.format_bytes(memory_budget)))
+
+    # column -> list of compact chunk parts, and the index of each chunk (index_col)
+    parts = dict((column, []) for column in columns)
+    index_parts = []
+    # without index_col, the default RangeIndex of the result is kept
+    keep_index = kwargs.get("index_col") not in (None, False)
+    loaded_bytes, peak_bytes, num_chunks = 0, 0, 0
+    for chunk in pd.read_csv(path, chunksize=chunksize, nrows=nrows, dtype=read_dtypes, **kwargs):
+        raw_bytes = pd_memory.estimate_usage(chunk)["bytes"].sum() + \
+            chunk.index.memory_usage(deep=True)
+        check_budget(loaded_bytes + raw_bytes, "reading chunk {}".format(num_chunks))
+        peak_bytes = max(peak_bytes, loaded_bytes + raw_bytes)
+
+        compact = _compact_chunk(chunk, dtypes, float_tolerance)
+        if keep_index:
+            index_parts.append(chunk.index)
+            loaded_bytes += chunk.index.memory_usage(deep=True)
+        del chunk
+        loaded_bytes += _usage_bytes(compact)
+        for column in columns:
+            parts[column].append(compact[column])
+        num_chunks += 1
+
+    # column by column, the parts of a column are freed once it is concatenated
+    result = pd.DataFrame()
+    final_bytes = 0
+    for column in columns:
+        column_parts = parts.pop(column)
+        series = _concat_column(column_parts) if column_parts else pd.Series([])
+        column_bytes = _usage_bytes({column: series})
+        check_budget(loaded_bytes + column_bytes, "concatenating column {}".format(column))
+        peak_bytes = max(peak_bytes, loaded_bytes + column_bytes)
+
+        loaded_bytes -= _usage_bytes(dict(enumerate(column_parts)))
+        del column_parts
+        result[column] = series
+        del series
+        final_bytes += column_bytes
+        loaded_bytes += column_bytes
+
+    if index_parts:
+        index = index_parts[0].append(index_parts[1:])
+        del index_parts
+        if columns:
+            result.index = index
+        else:
+            result = pd.DataFrame(index=index)
+        final_bytes += index.memory_usage(deep=True)
+
+    report = {"rows": len(result), "chunks": num_chunks,
+              "peak_bytes": peak_bytes, "final_bytes": final_bytes,
+              "peak_memory": pd_memory.format_bytes(peak_bytes),
+              "final_memory": pd_memory.format_bytes(final_bytes)}
+    return result, report
+
+if __name__ == "__main__":
+    data = pd.DataFrame({"id": np.arange(300000),
+                         "age": np.random.randint(0, 100, 300000),
+                         "score": np.random.random(300000),
+                         "city": np.random.choice(["beijing", "shanghai", "guangzhou"], 300000)})
+    data.to_csv("./pd_loader_demo.csv", index=False)
+
+    print pd_memory.mem_usage(pd.read_csv("./pd_loader_demo.csv"))
+    compact, report = read_csv_compact("./pd_loader_demo.csv", chunksize=100000, sample_rows=1000)
+    print compact.dtypes
+    print report
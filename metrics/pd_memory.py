@@ -1,13 +1,182 @@
 from __future__ import division
 
+import sys
+
 import numpy as np
 import pandas as pd
+from scipy import stats
+
+def _object_usage(values, sample_size, z, random_state):
+    """
+    internal function, estimate deep memory of an object array by sampling
+    Returns:
+        estimate, lower, upper in bytes
+    """
+    num_values = len(values)
+    sample = values[random_state.randint(0, num_values, sample_size)]
+    sizes = np.fromiter((sys.getsizeof(value) for value in sample), dtype=float, count=sample_size)
+
+    # pointers + objects, the same as memory_usage(deep=True)
+    estimate = values.nbytes + num_values * sizes.mean()
+    margin = z * num_values * sizes.std(ddof=1) / np.sqrt(sample_size)
+    return estimate, estimate - margin, estimate + margin
+
+def estimate_usage(df, sample_frac=0.01, min_sample=1000, confidence=0.95, seed=None):
+    """
+    Estimate the deep memory usage of each column. Object columns are estimated from a random
+    sample of their values, other columns (and small object columns) are exact.
+    Parameters:
+        df: a pandas dataframe or series
+        sample_frac: ratio of values sampled in object columns
+        min_sample: min number of values sampled, columns not longer than it are exact
+        confidence: confidence level of the bounds
+        seed: random seed of sampling
+    Returns:
+        a dataframe indexed by column (and "Index"), fields: bytes, lower, upper, exact
+    """
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+
+    z = stats.norm.ppf(0.5 + confidence / 2)
+    random_state = np.random.RandomState(seed)
 
-def mem_usage(df):
-    if isinstance(df, pd.DataFrame):
+    items = [("Index", df.index)] + [(column, df[column]) for column in df.columns]
+    rows = []
+    for name, values in items:
+        if values.dtype == np.object_ and len(values) > min_sample:
+            sample_size = max(min_sample, int(len(values) * sample_frac))
+            estimate, lower, upper = _object_usage(np.asarray(values), sample_size, z, random_state)
+            rows.append([name, estimate, max(lower, 0), upper, False])
+        else:
+            if isinstance(values, pd.Series):
+                usage_bytes = values.memory_usage(index=False, deep=True)
+            else:
+                usage_bytes = values.memory_usage(deep=True)
+            rows.append([name, usage_bytes, usage_bytes, usage_bytes, True])
+
+    agg = pd.DataFrame(rows, columns=["column", "bytes", "lower", "upper", "exact"])
+    return agg.set_index("column")
+
+def mem_usage(df, mode="auto", exact_rows=1000000, sample_frac=0.01, seed=None):
+    """
+    Parameters:
+        df: a pandas dataframe or series
+        mode: "exact" for memory_usage(deep=True), "estimate" for sampling object columns,
+            see estimate_usage, "auto" for exact if rows <= exact_rows, otherwise estimate
+        exact_rows: max number of rows measured exactly in auto mode
+        sample_frac: ratio of values sampled in object columns in estimate mode
+        seed: random seed of sampling
+    Returns:
+        formatted memory usage, such as "12.58 MB"
+    """
+    if mode == "estimate" or (mode == "auto" and len(df) > exact_rows):
+        usage_bytes = estimate_usage(df, sample_frac=sample_frac, seed=seed)["bytes"].sum()
+    elif isinstance(df, pd.DataFrame):
         usage_bytes = df.memory_usage(deep=True).sum()
     else:
         # series
         usage_bytes = df.memory_usage(deep=True)
+    return format_bytes(usage_bytes)
+
+def format_bytes(usage_bytes):
+    """
+    Parameters:
+        usage_bytes: number of bytes
+    Returns:
+        formatted memory usage, such as "12.58 MB"
+    """
     usage_mbytes = usage_bytes / (1024 ** 2)
     return "{:03.2f} MB".format(usage_mbytes)
+
+def _smallest_int_dtype(min_value, max_value, allow_unsigned=False):
+    """
+    internal function, the smallest integer dtype holding [min_value, max_value], signed unless
+    allow_unsigned, since arithmetic of unsigned columns wraps around (3 - 5 == 254)
+    """
+    candidates = [np.int8, np.int16, np.int32, np.int64]
+    if allow_unsigned and min_value >= 0:
+        candidates = [np.uint8, np.uint16, np.uint32, np.uint64]
+    for dtype in candidates:
+        if np.iinfo(dtype).min <= min_value and max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    # only uint64 holds values beyond int64
+    return np.dtype(np.uint64) if min_value >= 0 else np.dtype(np.int64)
+
+def optimize_series(series, category_ratio=0.5, float_tolerance=None, allow_unsigned=False):
+    """
+    Parameters:
+        series: a pandas series
+        category_ratio: object series whose ratio of unique values < category_ratio are
+            converted into category
+        float_tolerance: if given, float64 series are converted into float32 if the relative
+            error of every value <= float_tolerance
+        allow_unsigned: non-negative integer series may be downcast to unsigned dtypes, whose
+            subtraction wraps around, signed dtypes only by default
+    Returns:
+        the optimized series, or the same series if nothing can be saved
+    """
+    dtype = series.dtype
+
+    if pd.api.types.is_integer_dtype(dtype) and len(series) > 0:
+        new_dtype = _smallest_int_dtype(series.min(), series.max(), allow_unsigned)
+        if new_dtype.itemsize < dtype.itemsize:
+            return series.astype(new_dtype)
+
+    elif dtype == np.float64 and float_tolerance is not None:
+        converted = series.astype(np.float32)
+        if np.allclose(converted.values, series.values, rtol=float_tolerance, atol=0,
+                       equal_nan=True):
+            return converted
+
+    elif dtype == np.object_ and len(series) > 0:
+        if series.nunique() / len(series) < category_ratio:
+            return series.astype("category")
+
+    return series
+
+def optimize(df, category_ratio=0.5, float_tolerance=None, allow_unsigned=False):
+    """
+    Reduce the memory of a dataframe in place, column by column, so that only one column is
+    copied at a time:
+        integers are downcast to the smallest signed integer dtype, like
+            pd.to_numeric(downcast="integer")
+        object columns of low cardinality are converted into category
+        float64 columns are converted into float32 within float_tolerance, optional
+    Parameters:
+        df: a pandas dataframe, modified in place
+        category_ratio: object columns whose ratio of unique values < category_ratio are
+            converted into category
+        float_tolerance: if given, float64 columns are converted into float32 if the relative
+            error of every value <= float_tolerance, such as 1e-6
+        allow_unsigned: non-negative integer columns may be downcast to unsigned dtypes, whose
+            subtraction wraps around, signed dtypes only by default
+    Returns:
+        a dataframe indexed by column, fields: dtype_before, dtype_after, memory_before, memory_after
+    """
+    rows = []
+    for column in df.columns:
+        series = df[column]
+        dtype_before, memory_before = series.dtype, mem_usage(series)
+
+        optimized = optimize_series(series, category_ratio, float_tolerance, allow_unsigned)
+        if optimized is not series:
+            df[column] = optimized
+            del series
+
+        rows.append([column, dtype_before, df[column].dtype, memory_before, mem_usage(df[column])])
+
+    report = pd.DataFrame(rows, columns=["column", "dtype_before", "dtype_after", "memory_before",
+                                         "memory_after"])
+    return report.set_index("column")
+
+if __name__ == "__main__":
+    data = pd.DataFrame({"id": np.arange(100000),
+                         "age": np.random.randint(0, 100, 100000),
+                         "score": np.random.random(100000),
+                         "city": np.random.choice(["beijing", "shanghai", "guangzhou"], 100000),
+                         "name": ["user_{}".format(index) for index in range(100000)]})
+
+    print mem_usage(data)
+    print mem_usage(data, mode="estimate"), estimate_usage(data)
+    print optimize(data, float_tolerance=1e-6)
+    print mem_usage(data)
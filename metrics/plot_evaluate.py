@@ -9,82 +9,123 @@ import os
 import sys
 reload(sys)
 sys.setdefaultencoding("utf-8")
+
 import numpy as np
-import matplotlib.pyplot as plt
-import sklearn
-from sklearn import metrics
+# object oriented figures on the non-interactive Agg backend, no global pyplot state, so that
+# many plots can be rendered concurrently without a display
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 import model_evaluate as eva
+import parallel
 
-def plot_metrics(truth, pred):
+def _draw_ks(ax, curves, max_error):
+    """
+    internal function, KS Curve
+    """
+    opt, ks = curves.opt_cut, curves.ks
+    thresholds, pos_cum, neg_cum = curves.ks_cumulative(max_error)
+    ax.plot(thresholds, pos_cum, color="green", label="Positive")
+    ax.plot(thresholds, neg_cum, color="blue", label="Negative")
+    ax.set_xlim(0.0, 1.0)
+    ax.set_ylim(0.0, 1.0)
+    ax.set_title("KS Curve")
+    ax.set_xlabel("Predictions")
+    ax.set_ylabel("Cumulative Percentage")
+    ax.grid(True)
+    ax.legend(loc="upper left")
+
+    pos_cum = 1 - curves.tpr[curves.opt_index]
+    neg_cum = 1 - curves.fpr[curves.opt_index]
+    ax.plot([opt, opt], [pos_cum, neg_cum], color="red", linestyle="--")
+    ax.text(opt + 0.012, opt + 0.012, "KS={:.2f}".format(ks), fontsize=12)
+
+def _draw_roc(ax, curves, max_error):
+    """
+    internal function, ROC Curve
+    """
+    fpr, tpr = curves.roc_curve(max_error)
+    ax.plot(fpr, tpr)
+    ax.plot([0, 1], [0, 1], color="red", linestyle="--")
+    ax.grid(True)
+    ax.set_title("ROC Curve")
+    ax.set_xlabel("False Positive Ratio")
+    ax.set_ylabel("True Positive Ratio")
+
+    ax.text(0.512, 0.512, "AUC={:.2f}".format(curves.auc), fontsize=12)
+
+def _draw_pr(ax, curves, max_error):
+    """
+    internal function, Precision-Recall Curve
+    """
+    recall, precision = curves.pr_curve(max_error)
+    ax.plot(recall, precision)
+    ax.grid(True)
+    ax.set_title("PR Curve")
+    ax.set_xlabel("Recall")
+    ax.set_ylabel("Precision")
+
+def plot_metrics(truth=None, pred=None, curves=None, max_error=0.001, output_dir=".", dpi=150):
     """
     Parameters:
         truth: a list of ground truth, 1 or 0
         pred: a list of guess probabilities, range [0, 1]
+        curves: precomputed model_evaluate.EvaluationCurves, such as the one returned by
+            model_evaluate_exact(truth, pred, return_curves=True), truth and pred are not needed
+        max_error: curves are downsampled within this distance before plotting, None for all points
+        output_dir: directory of the plots, created if not exists
+        dpi: resolution of the plots
     Returns:
-        No returns, just plot some plots, including ROC Curve, KS Curve and PR Curve
+        paths of the plots, ks_curve.png, roc_curve.png and pr_curve.png under output_dir
     Raises:
         ValueError if both lengths of inputs are not equal
     """
-    if len(truth) != len(pred):
-        raise ValueError("Lengths of truth and guess must be equal!")
-
-    truth = np.asarray(truth).astype(int)
-    pred = np.asarray(pred).astype(float)
-
-    valid_indexes = np.logical_or(truth == 0, truth == 1)
-    truth = truth[valid_indexes]
-    pred = pred[valid_indexes]
-
-    auc, ks, opt, acc, prec, rec = eva.model_evaluate(truth, pred)
-
-    pos_data = pred[truth == 1]
-    neg_data = pred[truth == 0]
-
-    # KS Curve
-    plt.clf()
-    plt.hist(x=pos_data, bins=1000, range=(0.0, 1.0), color="green",
-            label="Positive", normed=True, cumulative=True, histtype="step")
-    plt.hist(x=neg_data, bins=1000, range=(0.0, 1.0), color="blue",
-            label="Negative", normed=True, cumulative=True, histtype="step")
-    plt.xlim(0.0, 1.0)
-    plt.ylim(0.0, 1.0)
-    plt.title("KS Curve")
-    plt.xlabel("Predictions")
-    plt.ylabel("Cumulative Percentage")
-    plt.grid()
-    plt.legend(loc="upper left")
-
-    pos_cum = sum(pos_data <= opt) * 1.0 / len(pos_data)
-    neg_cum = sum(neg_data <= opt) * 1.0 / len(neg_data)
-    plt.plot([opt, opt], [pos_cum, neg_cum], color="red", linestyle="--")
-    plt.text(opt + 0.012, opt + 0.012, "KS={:.2f}".format(ks), fontsize=12)
-
-    plt.savefig("./ks_curve.png", dpi=150)
-
-    # ROC Curve
-    fpr, tpr, _ = metrics.roc_curve(truth, pred, pos_label=1)
-    plt.clf()
-    plt.plot(fpr, tpr)
-    plt.plot([0, 1], [0, 1], color="red", linestyle="--")
-    plt.grid()
-    plt.title("ROC Curve")
-    plt.xlabel("False Positive Ratio")
-    plt.ylabel("True Positive Ratio")
-
-    plt.text(0.512, 0.512, "AUC={:.2f}".format(auc), fontsize=12)
-
-    plt.savefig("./roc_curve.png", dpi=150)
-
-    # Precision-Recall Curve 
-    precision, recall, _ = metrics.precision_recall_curve(truth, pred, pos_label=1) 
-    plt.clf()
-    plt.plot(recall, precision)
-    plt.grid()
-    plt.title("PR Curve")
-    plt.xlabel("Recall")
-    plt.ylabel("Precision")
-    plt.savefig("./pr_curve.png", dpi=150)
+    if curves is None:
+        _, curves = eva.model_evaluate_exact(truth, pred, return_curves=True)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    paths = []
+    for name, draw in [("ks_curve", _draw_ks), ("roc_curve", _draw_roc), ("pr_curve", _draw_pr)]:
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        draw(figure.add_subplot(111), curves, max_error)
+
+        path = os.path.join(output_dir, "{}.png".format(name))
+        figure.savefig(path, dpi=dpi)
+        paths.append(path)
+    return paths
+
+def _plot_metrics_helper(args):
+    """
+    internal function, render one item for the process pool
+    """
+    name, truth, pred, output_dir, max_error, dpi = args
+    output_dir = os.path.join(output_dir, str(name))
+    if isinstance(truth, eva.EvaluationCurves):
+        return name, plot_metrics(curves=truth, max_error=max_error, output_dir=output_dir, dpi=dpi)
+    return name, plot_metrics(truth, pred, max_error=max_error, output_dir=output_dir, dpi=dpi)
+
+def plot_metrics_batch(items, output_dir, n_jobs=1, max_error=0.001, dpi=150):
+    """
+    Render the plots of many models or segments
+    Parameters:
+        items: a list of (name, truth, pred), or (name, curves, None) with precomputed
+            model_evaluate.EvaluationCurves
+        output_dir: plots of each item are saved under output_dir/name/
+        n_jobs: number of processes, -1 means all cores
+        max_error: curves are downsampled within this distance before plotting
+        dpi: resolution of the plots
+    Returns:
+        a dict, name -> paths of the plots
+    """
+    # create the parent directory before forking, so that processes do not race on it
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    tasks = [(name, truth, pred, output_dir, max_error, dpi) for name, truth, pred in items]
+
+    return dict(parallel.pool_map(_plot_metrics_helper, tasks, n_jobs))
 
 
 if __name__ == "__main__":
@@ -98,3 +139,7 @@ if __name__ == "__main__":
         truths.append(1)
 
     plot_metrics(truths, preds)
+
+    items = [("model_{}".format(index), truths, np.asarray(preds) ** (index + 1))
+             for index in range(4)]
+    print plot_metrics_batch(items, "./plots", n_jobs=2)
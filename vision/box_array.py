@@ -0,0 +1,191 @@
+# a columnar container of boxes, shared by vision, metrics and visualize
+
+import numpy as np
+
+class BoxArray(object):
+    """
+    Struct of arrays of boxes:
+        coords: float32 array (N, 4), each row is (x1, y1, x2, y2), the same as iou
+        classes: int32 array (N, ), class ids
+        scores: float32 array (N, ), probabilities, 1 for ground truth
+        class_names: optional list, class id -> class name
+    Slicing (with or without steps) returns views of the same memory, np.asarray(boxes) returns
+    the coords.
+    """
+    def __init__(self, coords, classes=None, scores=None, class_names=None):
+        """
+        Parameters:
+            coords: array like (N, 4), (x1, y1, x2, y2)
+            classes: array like (N, ) of class ids, 0 by default
+            scores: array like (N, ), 1 by default
+            class_names: optional list, class id -> class name
+        Raises:
+            ValueError if lengths of inputs are not equal
+        """
+        self.coords = np.ascontiguousarray(coords, dtype=np.float32).reshape(-1, 4)
+        num_boxes = len(self.coords)
+        self.classes = np.zeros(num_boxes, dtype=np.int32) if classes is None else \
+            np.ascontiguousarray(classes, dtype=np.int32)
+        self.scores = np.ones(num_boxes, dtype=np.float32) if scores is None else \
+            np.ascontiguousarray(scores, dtype=np.float32)
+        self.class_names = class_names
+
+        if len(self.classes) != num_boxes or len(self.scores) != num_boxes:
+            raise ValueError("Lengths of coords, classes and scores must be equal!")
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, key):
+        """
+        a slice returns views, an integer returns a BoxArray of one box, index or mask arrays
+        return copies
+        """
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key + 1 if key != -1 else None)
+        # not through __init__, which would copy stepped slices into contiguous arrays
+        boxes = BoxArray.__new__(BoxArray)
+        boxes.coords = self.coords[key]
+        boxes.classes = self.classes[key]
+        boxes.scores = self.scores[key]
+        boxes.class_names = self.class_names
+        return boxes
+
+    def __array__(self, dtype=None):
+        return self.coords if dtype is None else self.coords.astype(dtype)
+
+    def __repr__(self):
+        return "BoxArray({} boxes)".format(len(self))
+
+    @property
+    def x1(self):
+        return self.coords[:, 0]
+
+    @property
+    def y1(self):
+        return self.coords[:, 1]
+
+    @property
+    def x2(self):
+        return self.coords[:, 2]
+
+    @property
+    def y2(self):
+        return self.coords[:, 3]
+
+    def areas(self):
+        """
+        Returns:
+            numpy array (N, ), 0 for degenerate boxes
+        """
+        return np.maximum(self.x2 - self.x1, 0) * np.maximum(self.y2 - self.y1, 0)
+
+    def labels(self):
+        """
+        Returns:
+            numpy array (N, ) of class names, or class ids if no class names
+        """
+        if self.class_names is None:
+            return self.classes
+        return np.asarray(self.class_names, dtype=object)[self.classes]
+
+    def scale(self, scale_x, scale_y=None):
+        """
+        Parameters:
+            scale_x: ratio of x coordinates, such as resized_width / width
+            scale_y: ratio of y coordinates, scale_x by default
+        Returns:
+            a new BoxArray
+        """
+        scale_y = scale_x if scale_y is None else scale_y
+        factors = np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+        return BoxArray(self.coords * factors, self.classes, self.scores, self.class_names)
+
+    def clip(self, width, height):
+        """
+        Parameters:
+            width, height: the image size
+        Returns:
+            a new BoxArray, coordinates clipped into [0, width] and [0, height]
+        """
+        upper = np.array([width, height, width, height], dtype=np.float32)
+        return BoxArray(np.clip(self.coords, 0, upper), self.classes, self.scores, self.class_names)
+
+    @classmethod
+    def from_dicts(cls, items, class_names=None):
+        """
+        Parameters:
+            items: [{"x1": 1, "x2": 2, "y1": 1, "y2": 2, "class": "cat", "prob": 0.8}, ...], the
+                format of metrics/map and vision/rpn, "prob" is optional
+            class_names: optional list of class names, built in order of appearance by default
+        Returns:
+            BoxArray
+        """
+        class_names = [] if class_names is None else list(class_names)
+        name_to_id = dict((name, index) for index, name in enumerate(class_names))
+        for item in items:
+            if item["class"] not in name_to_id:
+                name_to_id[item["class"]] = len(class_names)
+                class_names.append(item["class"])
+
+        coords = [[item["x1"], item["y1"], item["x2"], item["y2"]] for item in items]
+        classes = [name_to_id[item["class"]] for item in items]
+        scores = [item.get("prob", 1.0) for item in items]
+        return cls(coords, classes, scores, class_names)
+
+    def to_dicts(self):
+        """
+        Returns:
+            [{"x1": 1, "x2": 2, "y1": 1, "y2": 2, "class": "cat", "prob": 0.8}, ...]
+        """
+        labels = self.labels().tolist()
+        return [{"x1": x1, "y1": y1, "x2": x2, "y2": y2, "class": label, "prob": score}
+                for (x1, y1, x2, y2), label, score in zip(self.coords.tolist(), labels,
+                                                          self.scores.tolist())]
+
+    @classmethod
+    def from_class_dict(cls, bounding_boxes, class_mapping=None):
+        """
+        Parameters:
+            bounding_boxes: {1: [box1, box2, ...], 2: [box3, box4, ...], ...}, the format of
+                visualize/bbox_label, box: [x1, y1, x2, y2, prob]
+            class_mapping: optional number to name dict, {1: "cat", 2: "mouse", ...}
+        Returns:
+            BoxArray, class ids are the class numbers
+        """
+        rows, classes = [], []
+        for class_num, boxes in bounding_boxes.items():
+            rows.extend(boxes)
+            classes.extend([class_num] * len(boxes))
+        rows = np.asarray(rows, dtype=np.float32).reshape(-1, 5)
+
+        class_names = None
+        if class_mapping is not None:
+            class_names = [class_mapping.get(index) for index in range(max(class_mapping) + 1)]
+        return cls(rows[:, :4], classes, rows[:, 4], class_names)
+
+    def to_class_dict(self):
+        """
+        Returns:
+            {class id: [[x1, y1, x2, y2, prob], ...], ...}
+        """
+        rows = np.c_[self.coords, self.scores]
+        return dict((class_num, rows[self.classes == class_num].tolist())
+                    for class_num in np.unique(self.classes).tolist())
+
+    @classmethod
+    def from_tuples(cls, boxes):
+        """
+        Parameters:
+            boxes: [(x1, y1, x2, y2), ...], the format of vision/iou
+        Returns:
+            BoxArray
+        """
+        return cls(boxes)
+
+    def to_tuples(self):
+        """
+        Returns:
+            [(x1, y1, x2, y2), ...]
+        """
+        return [tuple(row) for row in self.coords.tolist()]
@@ -0,0 +1,70 @@
+# encode boxes into regression deltas relative to anchors and decode them back, boxes are
+# (x1, y1, x2, y2) as iou, deltas are [delta_center_x, delta_center_y, delta_width, delta_height]
+# as the rpn regression targets
+
+import numpy as np
+
+def _centers(boxes):
+    """
+    internal function, center x, center y, width and height of (N, 4) boxes
+    """
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    return boxes[:, 0] + widths / 2, boxes[:, 1] + heights / 2, widths, heights
+
+def encode(anchors, gt, variances=None, dtype=np.float32):
+    """
+    Parameters:
+        anchors: numpy array (N, 4) or BoxArray, each row is (x1, y1, x2, y2)
+        gt: numpy array (N, 4) or BoxArray, the ground truth box of each anchor
+        variances: optional 4 values, the deltas are divided by them
+        dtype: computation dtype, float32 by default
+    Returns:
+        numpy array (N, 4) of [delta_center_x, delta_center_y, delta_width, delta_height]
+        delta_center_x = (center_gt_x - center_anchor_x) / anchor_width
+        delta_width = log(gt_width / anchor_width), the same for y and height
+    """
+    anchors = np.asarray(anchors, dtype=dtype).reshape(-1, 4)
+    gt = np.asarray(gt, dtype=dtype).reshape(-1, 4)
+
+    anchor_x, anchor_y, anchor_width, anchor_height = _centers(anchors)
+    gt_x, gt_y, gt_width, gt_height = _centers(gt)
+
+    deltas = np.empty((len(anchors), 4), dtype=dtype)
+    deltas[:, 0] = (gt_x - anchor_x) / anchor_width
+    deltas[:, 1] = (gt_y - anchor_y) / anchor_height
+    deltas[:, 2] = np.log(gt_width / anchor_width)
+    deltas[:, 3] = np.log(gt_height / anchor_height)
+
+    if variances is not None:
+        deltas /= np.asarray(variances, dtype=dtype)
+    return deltas
+
+def decode(anchors, deltas, variances=None, max_delta=np.log(1000.0 / 16), dtype=np.float32):
+    """
+    Parameters:
+        anchors: numpy array (N, 4) or BoxArray, each row is (x1, y1, x2, y2)
+        deltas: numpy array (N, 4), see encode
+        variances: optional 4 values, the deltas are multiplied by them, the same as encode
+        max_delta: delta_width and delta_height are clipped to it so that exp() does not overflow
+        dtype: computation dtype, float32 by default
+    Returns:
+        numpy array (N, 4) of boxes, (x1, y1, x2, y2)
+    """
+    anchors = np.asarray(anchors, dtype=dtype).reshape(-1, 4)
+    deltas = np.asarray(deltas, dtype=dtype).reshape(-1, 4)
+    if variances is not None:
+        deltas = deltas * np.asarray(variances, dtype=dtype)
+
+    anchor_x, anchor_y, anchor_width, anchor_height = _centers(anchors)
+    center_x = deltas[:, 0] * anchor_width + anchor_x
+    center_y = deltas[:, 1] * anchor_height + anchor_y
+    width = np.exp(np.minimum(deltas[:, 2], max_delta)) * anchor_width
+    height = np.exp(np.minimum(deltas[:, 3], max_delta)) * anchor_height
+
+    boxes = np.empty((len(anchors), 4), dtype=dtype)
+    boxes[:, 0] = center_x - width / 2
+    boxes[:, 1] = center_y - height / 2
+    boxes[:, 2] = center_x + width / 2
+    boxes[:, 3] = center_y + height / 2
+    return boxes
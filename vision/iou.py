@@ -1,5 +1,7 @@
 # compute the Intersection over Union value.
 
+import numpy as np
+
 def iou(a, b):
     """
     Parameters:
@@ -34,3 +36,39 @@ def iou(a, b):
     union_area = union(a, b, intersection_area)
 
     return intersection_area * 1.0 / (union_area + 1e-6)
+
+def iou_matrix(boxes_a, boxes_b, max_elements=2 ** 24):
+    """
+    The vectorized version of iou for all pairs of boxes, the same semantics as iou
+    Parameters:
+        boxes_a: numpy array (N, 4), each row is (x1, y1, x2, y2)
+        boxes_b: numpy array (M, 4), each row is (x1, y1, x2, y2)
+        max_elements: max number of pairs computed at a time, rows of boxes_a are chunked so
+            that the temporary arrays stay bounded
+    Returns:
+        numpy array (N, M), intersection over union of each pair
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    num_a, num_b = len(boxes_a), len(boxes_b)
+
+    valid_a = np.logical_and(boxes_a[:, 0] < boxes_a[:, 2], boxes_a[:, 1] < boxes_a[:, 3])
+    valid_b = np.logical_and(boxes_b[:, 0] < boxes_b[:, 2], boxes_b[:, 1] < boxes_b[:, 3])
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    result = np.zeros((num_a, num_b))
+    chunk_size = max(1, max_elements // max(num_b, 1))
+    for start in range(0, num_a, chunk_size):
+        a = boxes_a[start: start + chunk_size]
+
+        w = np.minimum(a[:, None, 2], boxes_b[None, :, 2]) - np.maximum(a[:, None, 0], boxes_b[None, :, 0])
+        h = np.minimum(a[:, None, 3], boxes_b[None, :, 3]) - np.maximum(a[:, None, 1], boxes_b[None, :, 1])
+        intersection_area = np.where(np.logical_or(w < 0, h < 0), 0.0, w * h)
+        union_area = area_a[start: start + chunk_size, None] + area_b[None, :] - intersection_area
+
+        result[start: start + chunk_size] = intersection_area / (union_area + 1e-6)
+
+    result[~valid_a, :] = 0.0
+    result[:, ~valid_b] = 0.0
+    return result
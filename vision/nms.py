@@ -0,0 +1,129 @@
+# non-maximum suppression for detection post-processing, boxes are (x1, y1, x2, y2) as iou
+
+import numpy as np
+
+import iou
+
+def _top_k(scores, k):
+    """
+    internal function, indexes of the k highest scores in descending order, by partial sort
+    """
+    if k is not None and k < len(scores):
+        indexes = np.argpartition(-scores, k - 1)[:k]
+    else:
+        indexes = np.arange(len(scores))
+    return indexes[np.argsort(-scores[indexes], kind="mergesort")]
+
+def nms(boxes, scores, iou_threshold=0.7, pre_top_k=None, post_top_k=None):
+    """
+    Greedy non-maximum suppression, a box is suppressed if its iou with a kept box of a higher
+    score > iou_threshold
+    Parameters:
+        boxes: numpy array (N, 4), each row is (x1, y1, x2, y2)
+        scores: numpy array (N, )
+        iou_threshold: the max iou allowed between kept boxes
+        pre_top_k: only the pre_top_k highest scores take part in suppression
+        post_top_k: at most post_top_k boxes are kept
+    Returns:
+        numpy array of indexes of the kept boxes, in descending order of scores
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = _top_k(scores, pre_top_k)
+
+    # areas and validness computed once, iou of one box to many is then a few array operations
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    valid = np.logical_and(x1 < x2, y1 < y2)
+
+    keep = []
+    while len(order) > 0:
+        current = order[0]
+        keep.append(current)
+        if post_top_k is not None and len(keep) >= post_top_k:
+            break
+
+        rest = order[1:]
+        w = np.minimum(x2[current], x2[rest]) - np.maximum(x1[current], x1[rest])
+        h = np.minimum(y2[current], y2[rest]) - np.maximum(y1[current], y1[rest])
+        intersection_area = np.where(np.logical_or(w < 0, h < 0), 0.0, w * h)
+        ious = intersection_area / (areas[current] + areas[rest] - intersection_area + 1e-6)
+        ious[~np.logical_and(valid[current], valid[rest])] = 0.0
+
+        order = rest[ious <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+def batched_nms(boxes, scores, classes, iou_threshold=0.7, pre_top_k=None, post_top_k=None):
+    """
+    Non-maximum suppression within each class in one pass, boxes of different classes are moved
+    apart by class dependent offsets so that they never overlap
+    Parameters:
+        boxes: numpy array (N, 4), each row is (x1, y1, x2, y2)
+        scores: numpy array (N, )
+        classes: numpy array (N, ) of integer class ids
+        iou_threshold, pre_top_k, post_top_k: see nms, the top k are over all classes
+    Returns:
+        numpy array of indexes of the kept boxes, in descending order of scores
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    classes = np.asarray(classes)
+    _, class_ids = np.unique(classes, return_inverse=True)
+    offsets = class_ids * (boxes.max() - boxes.min() + 1)
+    return nms(boxes + offsets[:, None], scores, iou_threshold, pre_top_k, post_top_k)
+
+def soft_nms(boxes, scores, method="gaussian", iou_threshold=0.3, sigma=0.5, score_threshold=0.001,
+        pre_top_k=None, post_top_k=None):
+    """
+    Soft-NMS, the scores of overlapping boxes are decayed instead of removed
+    Parameters:
+        boxes: numpy array (N, 4), each row is (x1, y1, x2, y2)
+        scores: numpy array (N, )
+        method: "linear", score * (1 - iou) if iou > iou_threshold,
+            "gaussian", score * exp(-iou ^ 2 / sigma)
+        iou_threshold: iou threshold of the linear method
+        sigma: sigma of the gaussian method
+        score_threshold: boxes whose decayed scores < score_threshold are removed
+        pre_top_k: only the pre_top_k highest scores take part in suppression
+        post_top_k: at most post_top_k boxes are kept
+    Returns:
+        keep, new_scores
+        keep: numpy array of indexes of the kept boxes, in the order they are selected
+        new_scores: the decayed scores of the kept boxes
+    Raises:
+        ValueError if method is unknown
+    """
+    if method not in ("linear", "gaussian"):
+        raise ValueError("method must be linear or gaussian!")
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    order = _top_k(np.asarray(scores, dtype=np.float64), pre_top_k)
+    current_scores = np.asarray(scores, dtype=np.float64)[order]
+
+    keep, new_scores = [], []
+    while len(order) > 0:
+        best = np.argmax(current_scores)
+        if current_scores[best] < score_threshold:
+            break
+        keep.append(order[best])
+        new_scores.append(current_scores[best])
+        if post_top_k is not None and len(keep) >= post_top_k:
+            break
+
+        current = boxes[order[best]]
+        order = np.delete(order, best)
+        current_scores = np.delete(current_scores, best)
+
+        ious = iou.iou_matrix(current[None, :], boxes[order])[0]
+        if method == "linear":
+            current_scores = np.where(ious > iou_threshold, current_scores * (1 - ious), current_scores)
+        else:
+            current_scores = current_scores * np.exp(-ious * ious / sigma)
+
+        kept = current_scores >= score_threshold
+        order = order[kept]
+        current_scores = current_scores[kept]
+
+    return np.asarray(keep, dtype=np.int64), np.asarray(new_scores)
@@ -1,14 +1,46 @@
 # Region Proposal Network
 import numpy as np
-import random
 from keras import backend as K
 from keras.layers import Conv2D
 import tensorflow as tf
 
 import iou
+import box_array
+import box_coder
+import spatial_index
 
-def calc_rpn_label_regr(img_data, width, height, resized_width, resize_height, downsampling_ratio,
-        anchor_box_sizes, anchor_box_ratios, rpn_max_overlap, rpn_min_overlap):
+def _anchor_bbox_ious(anchors, boxes, sparse_threshold):
+    """
+    internal function, ious of anchor and bounding box pairs which overlap
+    Returns:
+        rows, cols, ious, rows are anchor indexes (sorted), cols are bounding box indexes
+    """
+    if len(anchors) * len(boxes) > sparse_threshold:
+        return spatial_index.sparse_iou(anchors, boxes)
+
+    ious = iou.iou_matrix(anchors, boxes)
+    rows, cols = np.nonzero(ious > 0)
+    return rows, cols, ious[rows, cols]
+
+def _first_max(groups, values, num_groups):
+    """
+    internal function, the max value of each group and the position of its first occurrence,
+    groups must be sorted
+    Returns:
+        max_values (0 for empty groups), first_positions (-1 for empty groups)
+    """
+    max_values = np.zeros(num_groups)
+    np.maximum.at(max_values, groups, values)
+    candidates = np.flatnonzero(np.logical_and(values == max_values[groups], values > 0))
+    found_groups, first_index = np.unique(groups[candidates], return_index=True)
+
+    first_positions = -1 * np.ones(num_groups, dtype=np.int64)
+    first_positions[found_groups] = candidates[first_index]
+    return max_values, first_positions
+
+def calc_rpn_label_regr(img_data, width, height, resized_width, resized_height, downsampling_ratio,
+        anchor_box_sizes, anchor_box_ratios, rpn_max_overlap, rpn_min_overlap, random_state=None,
+        sparse_threshold=10000000):
     """
     calculate rpn ground truth for one image
     Parameters:
@@ -16,6 +48,7 @@ def calc_rpn_label_regr(img_data, width, height, resized_width, resize_height, d
             {"filepath": /data/000000.png, "width": 224, "height": 224,
              "bboxes": [ {"class": "car", "x1": 1.0, "x2": 1.5, "y1": 1.0, "y2": 1.5}, ... ]
             }
+            bboxes can also be a BoxArray
         width: original image width
         height: original image height
         resized_width: resized width as model input
@@ -24,16 +57,80 @@ def calc_rpn_label_regr(img_data, width, height, resized_width, resize_height, d
         anchor_box_sizes: a list of sizes of the anchors
         anchor_box_ratios: a list of aspect ratios of the anchors
         rpn_max_overlap, rpn_min_overlap: the lower and upper threshold for the iou of rpn
+        random_state: None, an int seed or a np.random.RandomState to sample the regions
+        sparse_threshold: only overlapping anchor and bounding box pairs are compared by a spatial
+            index if there are more pairs than this number, the results are the same
     Returns:
         (rpn_labels, rpn_regr)
         rpn_labels: (1, feature_map_width, feature_map_height, 2 * number_anchors)
         rpn_regr: (1, feature_map_width, featutre_map_height, 2 * 4 * number_anchors)
     """
-    num_anchors = len(anchor_box_sizes) * len(anchor_box_ratios)
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    num_anchor_sizes = len(anchor_box_sizes)
     num_anchor_ratios = len(anchor_box_ratios)
-    num_bboxes = len(img_data["bboxes"])
+    num_anchors = num_anchor_sizes * num_anchor_ratios
     # get the output feature map size based on the model architecture downsampling ratio
-    fm_width, fm_height = resized_width / downsampling_ratio, resize_height / downsampling_ratio
+    fm_width, fm_height = int(resized_width // downsampling_ratio), int(resized_height // downsampling_ratio)
+
+    # convert bounding boxes in original images to that in resized images
+    # columns: [ x1, y1, x2, y2 ]
+    bboxes = img_data["bboxes"]
+    if isinstance(bboxes, box_array.BoxArray):
+        gta = bboxes.coords.astype(np.float64)
+        bbox_classes = bboxes.labels()
+    else:
+        gta = np.array([[bbox["x1"], bbox["y1"], bbox["x2"], bbox["y2"]] for bbox in bboxes],
+                       dtype=np.float64).reshape(-1, 4)
+        bbox_classes = [bbox["class"] for bbox in bboxes]
+    gta = gta * np.array([resized_width * 1.0 / width, resized_height * 1.0 / height,
+                          resized_width * 1.0 / width, resized_height * 1.0 / height])
+    num_bboxes = len(gta)
+    is_object = np.asarray(bbox_classes, dtype=object).reshape(-1) != "bg"
+
+    # all the anchors, in the order of (anchor size, anchor ratio, feature map x, feature map y)
+    size_idx, ratio_idx, ix, jy = [grid.ravel() for grid in np.meshgrid(np.arange(num_anchor_sizes),
+        np.arange(num_anchor_ratios), np.arange(fm_width), np.arange(fm_height), indexing="ij")]
+    sizes = np.asarray(anchor_box_sizes, dtype=float)
+    ratios = np.asarray(anchor_box_ratios, dtype=float).reshape(-1, 2)
+    anchor_width = sizes[size_idx] * ratios[ratio_idx, 0]
+    anchor_height = sizes[size_idx] * ratios[ratio_idx, 1]
+    anchors = np.c_[downsampling_ratio * (ix + 0.5) - anchor_width / 2,
+                    downsampling_ratio * (jy + 0.5) - anchor_height / 2,
+                    downsampling_ratio * (ix + 0.5) + anchor_width / 2,
+                    downsampling_ratio * (jy + 0.5) + anchor_height / 2]
+    anchor_channels = num_anchor_ratios * size_idx + ratio_idx
+
+    # only the anchors inside the resized image
+    valid = np.flatnonzero((anchors[:, 0] >= 0) & (anchors[:, 1] >= 0) &
+                           (anchors[:, 2] <= resized_width) & (anchors[:, 3] <= resized_height))
+    anchors, ix, jy, anchor_channels = anchors[valid], ix[valid], jy[valid], anchor_channels[valid]
+    num_valid = len(anchors)
+
+    rows, cols, ious = _anchor_bbox_ious(anchors, gta, sparse_threshold)
+
+    # the best bounding box of each anchor, and the first best anchor of each non-background
+    # bounding box
+    best_iou_for_anchor, best_pair_for_anchor = _first_max(rows, ious, num_valid)
+    object_pairs = np.flatnonzero(is_object[cols])
+    bbox_order = object_pairs[np.lexsort((rows[object_pairs], cols[object_pairs]))]
+    _, best_pair_for_bbox = _first_max(cols[bbox_order], ious[bbox_order], num_bboxes)
+    found = best_pair_for_bbox >= 0
+    best_pair_for_bbox[found] = bbox_order[best_pair_for_bbox[found]]
+
+    # number of anchors that one bounding box contains
+    num_anchors_for_bbox = np.bincount(cols[ious > rpn_max_overlap], minlength=num_bboxes)
+
+    # positive if the iou surpasses the upper threshold, neutral if the iou is in between lower
+    # and upper threshold, otherwise negative
+    is_pos = best_iou_for_anchor > rpn_max_overlap
+    is_neutral = np.zeros(num_valid, dtype=bool)
+    is_neutral[rows[(ious > rpn_min_overlap) & (ious < rpn_max_overlap)]] = True
+    if rpn_min_overlap < 0 < rpn_max_overlap:
+        # the anchors not overlapping with some bounding box have a zero iou in between
+        is_neutral |= np.bincount(rows, minlength=num_valid) < num_bboxes
+    is_neutral &= ~is_pos
 
     # stores the label of each anchor, indicating whether this anchor contains an object or not
     y_rpn_label = np.zeros((fm_height, fm_width, num_anchors))
@@ -41,127 +138,29 @@ def calc_rpn_label_regr(img_data, width, height, resized_width, resize_height, d
     y_is_box_valid = np.zeros((fm_height, fm_width, num_anchors))
     # stores the delta regressions of each anchor,
     # [delta_center_x, delta_center_y, delta_width, delta_height]
-    y_rpn_regr = np.zeros((fm_height, fm_width, num_anchors * 4))
-
-    # number of anchors that one bounding box contains
-    num_anchors_for_bbox = np.zeros(num_bboxes).astype(int)
-    # the best anchor that one bounding box contains
-    # [ feature_map_row_pixel_index, feature_map_column_pixel_index, anchor_ratio_index, anchor_size_index ]
-    best_anchor_for_bbox = -1 * np.ones((num_bboxes, 4)).astype(int)
-    # the best iou that one bounding box intersects with anchors
-    best_iou_for_bbox = np.zeros(num_bboxes).astype(np.float32)
-    # the best anchor regression target that one bounding box contains
-    # [ delta_center_x, delta_center_y, delta_width, delta_height ]
-    best_delta_for_bbox = np.zeros((num_bboxes, 4)).astype(np.float32)
-
-    # convert bounding boxes in original images to that in resized images
-    # columns: [ x1, x2, y1, y2 ]
-    gta = np.zeros((num_bboxes, 4))
-    for index, bbox in enumerate(img_data["bboxes"]):
-        gta[index, 0] = bbox["x1"] * (resized_width * 1.0 / width)
-        gta[index, 1] = bbox["x2"] * (resized_width * 1.0 / width)
-        gta[index, 2] = bbox["y1"] * (resized_height * 1.0 / height)
-        gta[index, 3] = bbox["y2"] * (resized_height * 1.0 / height)
-
-    # we start to iterate each combination of anchors
-    for anchor_size_idx in range(len(anchor_box_sizes)):
-        for anchor_ratio_idx in range(num_anchor_ratios):
-            # first we determine the (width, height) of the anchor
-            anchor_width = anchor_box_sizes[anchor_size_idx] * anchor_box_ratios[anchor_ratio_idx][0]
-            anchor_height = anchor_box_sizes[anchor_size_idx] * anchor_box_ratios[anchor_ratio_idx][1]
-
-            # then we traverse the feature map plane
-            for ix in range(fm_width):
-                # the anchor coordinates in resized image input
-                anchor_x1 = downsampling_ratio * (ix + 0.5) - anchor_width / 2
-                anchor_x2 = downsampling_ratio * (ix + 0.5) + anchor_width / 2
-
-                if anchor_x1 < 0 or anchor_x2 > resized_width:
-                    continue
-
-                for jy in range(fm_height):
-                    # the anchor coordinates in resized image input
-                    anchor_y1 = downsampling_ratio * (yj + 0.5) - anchor_height / 2
-                    anchor_y2 = downsampling_ratio * (yj + 0.5) + anchor_height / 2
-
-                    if anchor_y1 < 0 or anchor_y2 > resized_height:
-                        continue
-
-                    # ok, until now we get the specific anchor in resized image 
-                    # (anchor_x1, anchor_x2, anchor_y1, anchor_y2)
-                    current_anchor_coord = [ anchor_x1, anchor_y1, anchor_x2, anchor_y2 ]
-
-                    anchor_label = "neg"
-                    best_iou_for_anchor = 0.0
-
-                    for bbox_idx in range(num_bboxes):
-                        current_bbox_coord = [ gta[bbox_idx, 0], gta[bbox_idx, 2], gta[bbox_idx, 1], gta[bbox_idx, 3] ]
-                        current_iou = iou.iou(current_bbox_coord, current_anchor_coord)
-
-                        # calculate regression target
-                        center_bbox_x = (gta[bbox_idx, 0] + gta[bbox_idx, 1]) / 2.0
-                        center_bbox_y = (gta[bbox_idx, 2] + gta[bbox_idx, 3]) / 2.0
-                        center_anchor_x = (anchor_x1 + anchor_x2) / 2.0
-                        center_anchor_y = (anchor_y1 + anchor_y2) / 2.0
-                        bbox_width = gta[bbox_idx, 1] - gta[bbox_idx, 0]
-                        bbox_height = gta[bbox_idx, 3] - gta[bbox_idx, 2]
-
-                        delta_center_x = (center_bbox_x - center_anchor_x) / anchor_width
-                        delta_center_y = (center_bbox_y - center_anchor_y) / anchor_height
-                        delta_width = np.log(bbox_width / anchor_width)
-                        delta_height = np.log(bbox_height / anchor_height)
-
-                        # we should help non-background bounding box find a best anchor
-                        if img_data["bboxes"][bbox_idx]["class"] != "bg":
-                            if current_iou > best_iou_for_bbox[bbox_idx]:
-                                best_anchor_for_bbox[bbox_num] = [jy, ix, anchor_ratio_idx, anchor_size_idx]
-                                best_iou_for_bbox[bbox_num] = current_ious
-                                best_delta_for_bbox[bbox_num, :] = [delta_center_x, delta_center_y, delta_width, delta_height]
-
-                        # if the current iou surpasses the upper threshold, we will set the anchor
-                        # label to be true
-                        if current_iou > rpn_max_overlap:
-                            anchor_label = "pos"
-                            num_anchors_for_bbox[bbox_num] += 1
-                            # we should find the best regression target
-                            if current_iou > best_iou_for_anchor:
-                                best_iou_for_anchor = current_iou
-                                best_regr = (delta_center_x, delta_center_y, delta_width, delta_height)
-
-                        # if the current iou is in between lower and upper threshold, we will not
-                        # set the anchor label
-                        if current_ious > rpn_min_overlap and current_ious < rpn_max_overlap:
-                            if anchor_label != "pos":
-                                anchor_label = "neutral"
-
-                    # determine the classification target
-                    if anchor_label == "neg":
-                        y_is_box_valid[jy, ix, num_anchor_ratios * anchor_size_idx + anchor_ratio_idx] = 1
-                        y_rpn_label[jy, ix, num_anchor_ratios * anchor_size_idx + anchor_ratio_idx] = 0
-                    elif anchor_label == "neutral":
-                        y_is_box_valid[jy, ix, num_anchor_ratios * anchor_size_idx + anchor_ratio_idx] = 0
-                        y_rpn_label[jy, ix, num_anchor_ratios * anchor_size_idx + anchor_ratio_idx] = 0
-                    elif anchor_label == "pos":
-                        y_is_box_valid[jy, ix, num_anchor_ratios * anchor_size_idx + anchor_ratio_idx] = 1
-                        y_rpn_label[jy, ix, num_anchor_ratios * anchor_size_idx + anchor_ratio_idx] = 1
-                        start = 4 * (num_anchor_ratios * anchor_size_idx + anchor_ratio_idx)
-                        y_rpn_regr[jy, ix, start: start + 4] = best_regr
+    y_rpn_regr = np.zeros((fm_height, fm_width, num_anchors, 4))
 
+    y_is_box_valid[jy, ix, anchor_channels] = ~is_neutral
+    y_rpn_label[jy, ix, anchor_channels] = is_pos
+    pos = np.flatnonzero(is_pos)
+    pairs = best_pair_for_anchor[pos]
+    y_rpn_regr[jy[pos], ix[pos], anchor_channels[pos]] = \
+        box_coder.encode(anchors[rows[pairs]], gta[cols[pairs]], dtype=np.float64)
 
     # maybe some ground truth bounding box has no anchors iou more than upper threshold,
     # we should assign the best anchor for the ground truth
-    for idx in range(num_anchors_for_bbox.shape[0]):
-        if num_anchors_for_bbox[idx] == 0:
-            if best_anchor_for_bbox[idx, 0] == -1:
-                continue
-            jy, ix, ratio_index, size_index = best_anchor_for_bbox[idx, :]
-            y_is_box_valid[jy, ix, num_anchor_ratios * size_index + ratio_index] = 1
-            y_rpn_label[jy, ix, num_anchor_ratios * size_index + ratio_index] = 1
-            start = 4 * (num_anchor_ratios * size_index + ratio_index)
-            y_rpn_regp[jy, ix, start: start + 4] = best_delta_for_bbox[idx, :]
-
+    fallback = np.flatnonzero((num_anchors_for_bbox == 0) & (best_pair_for_bbox >= 0))
+    pairs = best_pair_for_bbox[fallback]
+    best = rows[pairs]
+    y_is_box_valid[jy[best], ix[best], anchor_channels[best]] = 1
+    y_rpn_label[jy[best], ix[best], anchor_channels[best]] = 1
+    y_rpn_regr[jy[best], ix[best], anchor_channels[best]] = \
+        box_coder.encode(anchors[best], gta[cols[pairs]], dtype=np.float64)
+
+    y_rpn_regr = y_rpn_regr.reshape(fm_height, fm_width, num_anchors * 4)
     y_rpn_label = np.expand_dims(y_rpn_label, axis=0)
     y_is_box_valid = np.expand_dims(y_is_box_valid, axis=0)
+    y_rpn_regr = np.expand_dims(y_rpn_regr, axis=0)
 
     positives = np.where(np.logical_and(y_rpn_label[0, :, :, :] == 1, y_is_box_valid[0, :, :, :] == 1))
     negatives = np.where(np.logical_and(y_rpn_label[0, :, :, :] == 0, y_is_box_valid[0, :, :, :] == 1))
@@ -173,13 +172,15 @@ def calc_rpn_label_regr(img_data, width, height, resized_width, resize_height, d
     # total number
     num_regions = 256
 
-    if num_positives > num_regions / 2:
-        sampled_positives = random.sample(range(num_positives), num_positives - num_regions / 2)
+    if num_positives > num_regions // 2:
+        sampled_positives = random_state.choice(num_positives, num_positives - num_regions // 2,
+                                                replace=False)
         y_is_box_valid[0, positives[0][sampled_positives], positives[1][sampled_positives], positives[2][sampled_positives]] = 0
-        num_positives = num_regions / 2
+        num_positives = num_regions // 2
 
     if num_negatives + num_positives > num_regions:
-        sampled_negatives = random.sample(range(num_negatives), num_negatives + num_positives - num_regions)
+        sampled_negatives = random_state.choice(num_negatives, num_negatives + num_positives - num_regions,
+                                                replace=False)
         y_is_box_valid[0, negatives[0][sampled_negatives], negatives[1][sampled_negatives], negatives[2][sampled_negatives]] = 0
         num_negatives = num_regions - num_positives
 
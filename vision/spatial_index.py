@@ -0,0 +1,113 @@
+# a uniform grid index to find overlapping boxes without comparing all pairs
+
+import numpy as np
+
+def _valid(boxes):
+    """
+    internal function, boxes with positive width and height, the same as iou
+    """
+    return np.logical_and(boxes[:, 0] < boxes[:, 2], boxes[:, 1] < boxes[:, 3])
+
+def _cells(boxes, cell_size):
+    """
+    internal function, explode boxes into the grid cells they cover
+    Returns:
+        box_ids, cell_x, cell_y
+    """
+    x0 = np.floor(boxes[:, 0] / cell_size).astype(np.int64)
+    x1 = np.floor(boxes[:, 2] / cell_size).astype(np.int64)
+    y0 = np.floor(boxes[:, 1] / cell_size).astype(np.int64)
+    y1 = np.floor(boxes[:, 3] / cell_size).astype(np.int64)
+    num_x = x1 - x0 + 1
+    counts = num_x * (y1 - y0 + 1)
+
+    box_ids = np.repeat(np.arange(len(boxes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_x = x0[box_ids] + offsets % num_x[box_ids]
+    cell_y = y0[box_ids] + offsets // num_x[box_ids]
+    return box_ids, cell_x, cell_y
+
+def overlapping_pairs(boxes_a, boxes_b, cell_size=None):
+    """
+    Find all pairs of boxes whose intersection has positive area, that is iou > 0
+    Parameters:
+        boxes_a: numpy array (N, 4), each row is (x1, y1, x2, y2)
+        boxes_b: numpy array (M, 4), each row is (x1, y1, x2, y2)
+        cell_size: side length of the grid cells, the median box size by default
+    Returns:
+        rows, cols
+        rows: indexes of boxes_a, sorted
+        cols: indexes of boxes_b, sorted within the same row
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    ids_a = np.flatnonzero(_valid(boxes_a))
+    ids_b = np.flatnonzero(_valid(boxes_b))
+    if len(ids_a) == 0 or len(ids_b) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    a, b = boxes_a[ids_a], boxes_b[ids_b]
+
+    if cell_size is None:
+        sides = np.r_[np.maximum(a[:, 2] - a[:, 0], a[:, 3] - a[:, 1]),
+                      np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1])]
+        cell_size = np.median(sides)
+
+    # cell keys of both sides, then join boxes sharing a cell
+    cells_a = _cells(a, cell_size)
+    cells_b = _cells(b, cell_size)
+    min_x = min(cells_a[1].min(), cells_b[1].min())
+    min_y = min(cells_a[2].min(), cells_b[2].min())
+    span_y = max(cells_a[2].max(), cells_b[2].max()) - min_y + 1
+    keys_a = (cells_a[1] - min_x) * span_y + (cells_a[2] - min_y)
+    keys_b = (cells_b[1] - min_x) * span_y + (cells_b[2] - min_y)
+
+    order_b = np.argsort(keys_b, kind="mergesort")
+    keys_b = keys_b[order_b]
+    starts = np.searchsorted(keys_b, keys_a, side="left")
+    counts = np.searchsorted(keys_b, keys_a, side="right") - starts
+
+    entries_a = np.repeat(np.arange(len(keys_a)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    entries_b = order_b[np.repeat(starts, counts) + positions]
+    rows = cells_a[0][entries_a]
+    cols = cells_b[0][entries_b]
+
+    # overlap with positive area
+    left = np.maximum(a[rows, 0], b[cols, 0])
+    bottom = np.maximum(a[rows, 1], b[cols, 1])
+    overlapped = np.logical_and(np.minimum(a[rows, 2], b[cols, 2]) > left,
+                                np.minimum(a[rows, 3], b[cols, 3]) > bottom)
+
+    # a pair shares several cells if the boxes are large, only keep it in the cell containing
+    # the left bottom corner of the intersection
+    owner = np.logical_and(np.floor(left / cell_size).astype(np.int64) == cells_a[1][entries_a],
+                           np.floor(bottom / cell_size).astype(np.int64) == cells_a[2][entries_a])
+    kept = np.logical_and(overlapped, owner)
+
+    rows, cols = ids_a[rows[kept]], ids_b[cols[kept]]
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order]
+
+def sparse_iou(boxes_a, boxes_b, cell_size=None):
+    """
+    Intersection over union of overlapping pairs only, all other pairs have iou 0
+    Parameters:
+        boxes_a: numpy array (N, 4), each row is (x1, y1, x2, y2)
+        boxes_b: numpy array (M, 4), each row is (x1, y1, x2, y2)
+        cell_size: side length of the grid cells, the median box size by default
+    Returns:
+        rows, cols, ious, see overlapping_pairs, ious are the same values as iou.iou_matrix
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    rows, cols = overlapping_pairs(boxes_a, boxes_b, cell_size)
+    a, b = boxes_a[rows], boxes_b[cols]
+
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    w = np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+    h = np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+    intersection_area = w * h
+    union_area = area_a + area_b - intersection_area
+
+    return rows, cols, intersection_area / (union_area + 1e-6)
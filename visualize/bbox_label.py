@@ -6,6 +6,8 @@ import numpy as np
 import cv2
 import colorsys
 
+from ..vision import box_array
+
 def _create_color(tag, hue_step=0.41):
     """
     create an unique RGB color code for a specific tag
@@ -24,9 +26,13 @@ def draw_bboxes_and_labels_on_image(img, class_mapping, bounding_boxes):
         bounding_boxes: class number to boxes list
             {1: [box1, box2, ...], 2: [box3, box4, ...], ...}
             box: [x1, y1, x2, y2, prob]
+            or a BoxArray whose class ids are the class numbers
     Returns:
         original image + boungding boxes + label texts 
     """
+    if isinstance(bounding_boxes, box_array.BoxArray):
+        bounding_boxes = bounding_boxes.to_class_dict()
+
     for class_num, boxes in bounding_boxes.items():
         for box in boxes:
             assert len(box) == 5, "box must have five items: [x1, y1, x2, y2, prob]"